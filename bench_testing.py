@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the marking harness itself (testing.py): each phase
+# is timed separately, on synthetic submissions and test tables of
+# several sizes. Results are written as JSON; with --baseline, they are
+# compared to a saved run, and the exit status is 1 if any phase got
+# slower by more than the threshold.
+#
+#   python bench_testing.py --output base.json
+#   (change testing.py)
+#   python bench_testing.py --baseline base.json
+
+from testing import ModuleTestBase, FunctionTestBase, StagedTest
+
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import time
+
+import q5
+
+# the allowed modules of mark_q5 (those that are installed)
+bench_modules = ['math', 'numpy', 'bisect', 'heapq', 'matplotlib.pyplot', 'itertools',
+                 'statistics', 'scipy.special', 'scipy', 'scipy.signal', 'typing', 'numbers']
+
+def installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:
+        return False
+
+class BenchModuleTest (ModuleTestBase):
+
+    allowed_modules = [name for name in bench_modules if installed(name)]
+
+    ## end class BenchModuleTest
+
+def make_submission(directory, n_functions):
+    # a submission of peaks_valleys plus n_functions helper functions,
+    # each with a few lines of loops, calls and comprehensions
+    lines = ["import math", "import itertools", ""]
+    for k in range(n_functions):
+        lines += ["def helper_" + str(k) + "(seq, limit = " + str(k) + "):",
+                  "    '''helper " + str(k) + "'''",
+                  "    total = 0",
+                  "    for i, x in enumerate(seq):",
+                  "        if x > limit and i % 2 == 0:",
+                  "            total += math.floor(x) * " + str(k),
+                  "    return [y for y in itertools.islice(seq, total) if y]",
+                  ""]
+    lines += ["def peaks_valleys(seq):",
+              "    count = 0",
+              "    for i in range(1, len(seq) - 1):",
+              "        if seq[i-1] < seq[i] > seq[i+1] or seq[i-1] > seq[i] < seq[i+1]:",
+              "            count += 1",
+              "    return count",
+              ""]
+    path = os.path.join(directory, "sub_" + str(n_functions) + ".py")
+    with open(path, 'w') as f:
+        f.write("\n".join(lines))
+    return path
+
+def make_tests(n_tests, length = 20):
+    rng = random.Random(n_tests)
+    tests = []
+    for k in range(n_tests):
+        seq = [rng.randint(-10, 10) for i in range(length)]
+        tests.append(((seq,), q5.peaks_valleys(seq)))
+    return tuple(tests)
+
+def wrong_answer(seq):
+    return -1
+
+def time_it(setup, phase, repeat, teardown = None):
+    # times of repeat runs of phase(setup()), in seconds; setup and
+    # teardown(setup()) are not timed
+    times = []
+    for r in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        phase(arg)
+        times.append(time.perf_counter() - start)
+        if teardown is not None:
+            teardown(arg)
+    return times
+
+def _child_pre_test_run(path, conn):
+    test = BenchModuleTest(path, raise_exceptions = False)
+    start = time.perf_counter()
+    test.pre_test_run()
+    conn.send(time.perf_counter() - start)
+    conn.close()
+
+def time_pre_test_run(path, repeat):
+    # pre_test_run disables open, exec, ... for good, so it is timed
+    # in a new (forked) process each time
+    times = []
+    for r in range(repeat):
+        recv_conn, send_conn = multiprocessing.Pipe(duplex = False)
+        proc = multiprocessing.Process(target = _child_pre_test_run,
+                                       args = (path, send_conn))
+        proc.start()
+        send_conn.close()
+        times.append(recv_conn.recv())
+        recv_conn.close()
+        proc.join()
+    return times
+
+def parsed(path):
+    test = BenchModuleTest(path, raise_exceptions = False)
+    test._parse_file()
+    return test
+
+def checked(path):
+    test = parsed(path)
+    test.test_CHECK()
+    return test
+
+def run_benchmarks(sizes, table_lengths, stage_counts, repeat):
+    '''Returns a dict of benchmark name: list of times (seconds).'''
+    results = dict()
+    directory = tempfile.mkdtemp(prefix = "bench_testing_")
+    try:
+        for n in sizes:
+            path = make_submission(directory, n)
+            suffix = "/functions=" + str(n)
+            results["parse" + suffix] = time_it(
+                lambda: BenchModuleTest(path, raise_exceptions = False),
+                lambda test: test._parse_file(), repeat)
+            results["check" + suffix] = time_it(
+                lambda: parsed(path), lambda test: test.test_CHECK(), repeat)
+            results["load" + suffix] = time_it(
+                lambda: checked(path), lambda test: test._load_functions(), repeat,
+                lambda test: test.cleanup())
+        results["pre_test_run"] = time_pre_test_run(path, repeat)
+        for n in stage_counts:
+            def staged_test():
+                stages = tuple([FunctionTestBase(q5.peaks_valleys, make_tests(1),
+                                                 raise_exceptions = False)
+                                for k in range(n)])
+                return StagedTest(stages, 0, False, 10)
+            results["stage_processes/stages=" + str(n)] = time_it(
+                staged_test, lambda st: st.run(), repeat)
+        for n in table_lengths:
+            tests = make_tests(n)
+            for collate in (0, 1, 2):
+                def function_test():
+                    ft = FunctionTestBase(wrong_answer, tests, raise_exceptions = False,
+                                          suppress_output = True)
+                    ft.collate = collate
+                    return ft
+                results["collate=" + str(collate) + "/tests=" + str(n)] = time_it(
+                    function_test, lambda ft: ft.run([]), repeat)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return results
+
+def summarise(results):
+    benchmarks = dict()
+    for (name, times) in results.items():
+        times = sorted(times)
+        benchmarks[name] = dict(median = times[len(times) // 2], min = times[0],
+                                max = times[-1], repeat = len(times))
+    return dict(host = socket.gethostname(), python = platform.python_version(),
+                platform = platform.platform(), cpus = os.cpu_count(),
+                time = time.time(), benchmarks = benchmarks)
+
+def compare(report, baseline, threshold):
+    '''Prints the ratio of each median time to the baseline's; returns
+    the names of the benchmarks that are slower by more than threshold
+    (a fraction, e.g. 0.1 for 10%).'''
+    slower = []
+    for (name, result) in sorted(report['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            print(name + ": new, " + "{:.6f}".format(result['median']) + " s")
+            continue
+        base = baseline['benchmarks'][name]['median']
+        ratio = result['median'] / base if base > 0 else float('inf')
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            slower.append(name)
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(name + ": " + "{:.6f}".format(result['median']) + " s, baseline " + \
+              "{:.6f}".format(base) + " s, x" + "{:.2f}".format(ratio) + flag)
+    if baseline.get('host') != report['host']:
+        print("(note: the baseline was run on " + str(baseline.get('host')) + ")")
+    return slower
+
+from argparse import ArgumentParser
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('--repeat', '-r', type=int, default=7,
+                        help="number of timed runs of each benchmark (the median is compared)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help="numbers of helper functions in the synthetic submissions")
+    parser.add_argument('--tests', type=int, nargs='+', default=[10, 100, 1000],
+                        help="test table lengths, for message collation")
+    parser.add_argument('--stages', type=int, nargs='+', default=[1, 7],
+                        help="numbers of stages, for stage process setup")
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help="write the results (JSON) to this file instead of stdout")
+    parser.add_argument('--baseline', type=str, default=None,
+                        help="compare to the results saved in this file")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="with --baseline, the slowdown (fraction) that counts "
+                        "as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.tests, args.stages, args.repeat)
+    report = summarise(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 1, sort_keys = True)
+    elif args.baseline is None:
+        json.dump(report, sys.stdout, indent = 1, sort_keys = True)
+        print()
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if len(compare(report, baseline, args.threshold)) > 0:
+            sys.exit(1)
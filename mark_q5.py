@@ -1,19 +1,50 @@
 # -*- coding: utf-8 -*-
 
-from testing import ModuleTestBase, FunctionTestBase, StagedTest
+from testing import ModuleTestBase, FunctionTestBase, StagedTest, BatchTest, \
+    ResultCache, TimeoutCalibration, FunctionTestComplexity, FunctionTestGenerated, \
+    JSONResultWriter, MarkingServer, FunctionTestDifferential
+
+import random
+import time
 
 import math
 math.inf = float('inf')
 
+class DifferentialBatch (list):
+    # argument tuples, plus the flat array and offsets of their sequences
+    flat = None
+    offsets = None
+
+    ## end class DifferentialBatch
+
 class ExamTest (ModuleTestBase):
 
-    def __init__(self, arg1, verbose = 0, raise_exceptions = True, timeout = None):
+    def __init__(self, arg1, verbose = 0, raise_exceptions = True, timeout = None,
+                 cache = None, case_timeout = None, calibration = None,
+                 complexity = False, generated = False, parallel_stages = 1,
+                 instrument = False, fail_fast = None, differential = False):
         ModuleTestBase.__init__(self, arg1, verbose, raise_exceptions)
         self.timeout = timeout
-        self.allowed_modules = ['math', 'numpy', 'bisect', 'heapq', 'matplotlib.pyplot', 'itertools', 'statistics','scipy.special','scipy','scipy.signal', 'typing', 'numbers']
+        self.cache = cache
+        self.case_timeout = case_timeout
+        self.complexity = complexity
+        self.generated = generated
+        self.parallel_stages = parallel_stages
+        self.instrument = instrument
+        self.fail_fast = fail_fast
+        self.differential = differential
+        # a measured TimeoutCalibration overrides both time-outs
+        if calibration is not None:
+            self.timeout = calibration.stage_timeouts
+            self.case_timeout = calibration.case_timeouts
+
+    allowed_modules = ['math', 'numpy', 'bisect', 'heapq', 'matplotlib.pyplot', 'itertools', 'statistics','scipy.special','scipy','scipy.signal', 'typing', 'numbers']
 
     fun_name = "peaks_valleys"
 
+    # the reference solution, used by the optional stages
+    reference_modules = ('q5',)
+
     # test1: sequence length 0-2
     test1 = (
         # length 0
@@ -26,14 +57,116 @@ class ExamTest (ModuleTestBase):
         (([2, 2],), 0,),
     )  
 
-    def mark(self):
+    # the test tables, in stage order
+    stage_tests = (test1,)
+
+    # optional complexity stage: inputs of size n with about n/3
+    # peaks and valleys, compared to the solution in q5.py
+    @staticmethod
+    def complexity_input(n):
+        rng = random.Random(n)
+        return ([rng.randint(-100, 100) for i in range(n)],)
+
+    complexity_budget = 2.0
+
+    # optional generated stage: large random sequences, answers from
+    # the vectorised solution in q5.py; plateau is the probability
+    # that an element repeats the one before it
+    test_generated = (
+        dict(size = 1000, seed = 1, low = -5, high = 5, plateau = 0.0),
+        dict(size = 1000, seed = 2, low = -5, high = 5, plateau = 0.3),
+        dict(size = 100000, seed = 3, low = -1000, high = 1000, plateau = 0.1),
+        dict(size = 100000, seed = 4, low = 0, high = 1, plateau = 0.5),
+        dict(size = 1000000, seed = 5, low = -10 ** 6, high = 10 ** 6, plateau = 0.05),
+    )
+
+    @staticmethod
+    def generated_test(spec):
+        import numpy as np
+        import q5
+        rng = np.random.default_rng(spec['seed'])
+        size = spec['size']
+        values = rng.integers(spec['low'], spec['high'], size, endpoint = True)
+        # plateaus: repeated elements take the value of the last
+        # element before them that is not repeated
+        repeat = rng.random(size) < spec['plateau']
+        repeat[0] = False
+        source = np.where(repeat, 0, np.arange(size))
+        values = values[np.maximum.accumulate(source)]
+        return (values.tolist(),), q5.peaks_valleys_array(values)
+
+    # optional differential stage: short random sequences of small
+    # values (so with many plateaus, negative values and equal
+    # neighbours), compared to the solution in q5.py; a batch keeps
+    # the flat array and offsets it was cut from, for the fast form
+    # of peaks_valleys_batch
+    @staticmethod
+    def differential_batch(seed, size):
+        import numpy as np
+        rng = np.random.default_rng(seed)
+        lengths = rng.integers(0, 12, size)
+        offsets = np.zeros(size + 1, dtype = np.int64)
+        np.cumsum(lengths, out = offsets[1:])
+        flat = rng.integers(-3, 3, int(offsets[-1]), endpoint = True)
+        values = flat.tolist()
+        ends = offsets.tolist()
+        batch = DifferentialBatch([(values[start:end],) for (start, end)
+                                   in zip(ends[:-1], ends[1:])])
+        batch.flat, batch.offsets = flat, offsets
+        return batch
+
+    @staticmethod
+    def differential_reference(batch):
+        import q5
+        if isinstance(batch, DifferentialBatch):
+            return q5.peaks_valleys_batch(batch.flat, batch.offsets).tolist()
+        return q5.peaks_valleys_batch([args[0] for args in batch]).tolist()
+
+    differential_budget = 1.0
+
+    def cache_settings(self):
+        return ModuleTestBase.cache_settings(self) + \
+            (self.timeout, self.case_timeout, self.complexity, self.generated,
+             self.instrument, self.fail_fast, self.differential)
+
+    def grade(self):
+        # returns (mark, msg); details are left in self.record
+        result = self.cached_result()
+        if result is not None:
+            mark, msg, self.record = result
+            return mark, msg
+        self.timed_out = False
+        self.stage_records = []
+        start = time.monotonic()
+        try:
+            mark, msg = self.grade_tests()
+        finally:
+            # (drops this submission from the import guard)
+            self.cleanup()
+        self.record = dict(time = time.monotonic() - start,
+                           stages = self.stage_records)
+        # a timeout may be due to a loaded machine; don't remember it
+        if not self.timed_out:
+            self.store_result(mark, msg, self.record)
+        return mark, msg
+
+    @staticmethod
+    def stage_limit(limit, index, default):
+        # calibrated time limits are lists, by stage (test1, then the
+        # generated stage if calibrated with it); a stage that was not
+        # calibrated gets default
+        if isinstance(limit, list):
+            if index < len(limit):
+                return limit[index]
+            return default
+        return limit
+
+    def grade_tests(self):
         ok, fun, msg = self.find_function(self.fun_name)
         if not ok:
-            print("0|" + msg)
-            return            
+            return 0, msg
         if fun is None:
-            print("0|" + msg)
-            return
+            return 0, msg
         ft_1 = FunctionTestBase(fun, self.test1,
                                          verbose = self.verbose - 1,
                                          raise_exceptions = self.raise_exceptions,
@@ -41,27 +174,143 @@ class ExamTest (ModuleTestBase):
         
 
         ft_1.collate = 0
+        ft_1.fail_fast = self.fail_fast
+        ft_1.case_timeout = self.stage_limit(self.case_timeout, 0, None)
+
+        stages = (ft_1,)
+        timeout = self.timeout
+        if isinstance(timeout, list):
+            timeout = timeout[:1]
+        if self.generated:
+            ft_g = FunctionTestGenerated(fun, self.test_generated,
+                                         ExamTest.generated_test,
+                                         verbose = self.verbose - 1,
+                                         raise_exceptions = self.raise_exceptions,
+                                         suppress_output = (self.verbose == 0))
+            ft_g.collate = 1
+            ft_g.fail_fast = self.fail_fast
+            ft_g.case_timeout = self.stage_limit(self.case_timeout, 1, None)
+            stages = stages + (ft_g,)
+            if isinstance(timeout, list):
+                timeout = timeout + [self.stage_limit(self.timeout, 1, self.timeout[0])]
+        if self.differential:
+            import q5
+            ft_d = FunctionTestDifferential(fun, q5.peaks_valleys,
+                                            ExamTest.differential_batch,
+                                            batch_reference = ExamTest.differential_reference,
+                                            time_budget = self.differential_budget,
+                                            verbose = self.verbose - 1,
+                                            raise_exceptions = self.raise_exceptions,
+                                            suppress_output = (self.verbose == 0))
+            ft_d.collate = 1
+            stages = stages + (ft_d,)
+            if isinstance(timeout, list):
+                timeout = timeout + [4 * self.differential_budget]
+        if self.complexity:
+            import q5
+            ft_c = FunctionTestComplexity(fun, q5.peaks_valleys,
+                                          ExamTest.complexity_input,
+                                          time_budget = self.complexity_budget,
+                                          verbose = self.verbose - 1,
+                                          raise_exceptions = self.raise_exceptions,
+                                          suppress_output = (self.verbose == 0))
+            ft_c.collate = 1
+            stages = stages + (ft_c,)
+            if isinstance(timeout, list):
+                timeout = timeout + [4 * self.complexity_budget]
 
-        st = StagedTest((ft_1,), self.verbose, self.raise_exceptions, self.timeout)
+        for stage in stages:
+            stage.instrument = self.instrument
+        st = StagedTest(stages, self.verbose, self.raise_exceptions, timeout,
+                        self.parallel_stages)
+        st.module_test = self
         st.collate = 1
         ok, msg = st.run()
+        self.timed_out = len(st.timeouts) > 0
+        self.stage_records = st.stage_records()
         if ok:
             mark = 7
             msg = "all tests passed"
         else:
+            # 7 marks, in equal parts for the stages passed (one mark
+            # per stage with the original seven stages)
             stages_ok = st.solved()
-            totals_by_stage = st.totals_by_stage()
-            passed_by_stage = [ passed for (passed, failed) in totals_by_stage]
-            assert len(passed_by_stage) == 7
-            if len(stages_ok) == 7:
-                mark = 7
-            else:
-                mark = len(stages_ok)
+            mark = 7 * len(stages_ok) // len(stages)
+        return mark, msg
+
+    def mark(self):
+        mark, msg = self.grade()
         print(str(mark) + '|' + msg)
 
     ## end ExamTest
 
 
+def mark_file(filepath, **exam_args):
+    exam = ExamTest(filepath, **exam_args)
+    mark, msg = exam.grade()
+    return mark, msg, exam.record
+
+def mark_batch(paths, jobs = None, file_timeout = None, dedup = False,
+               jsonl = None, **exam_args):
+    # exam_args are passed to ExamTest (verbose, timeout, cache, ...);
+    # with jsonl, a record for each file is added to that file, and
+    # files already recorded in it are not marked again
+    writer = None
+    done = dict()
+    if jsonl is not None:
+        writer = JSONResultWriter(jsonl)
+        done = writer.done()
+    def mark_one(filepath):
+        return mark_file(filepath, **exam_args)
+    def lookup(filepath):
+        if filepath in done:
+            return done[filepath]['mark'], done[filepath]['msg']
+        return ExamTest(filepath, **exam_args).cached_result()
+    def group_key(filepath):
+        if not dedup:
+            return None
+        return ExamTest(filepath, raise_exceptions = False).normalised_fingerprint()
+    # this process is the warm template that every worker forks from
+    batch = BatchTest(mark_one, paths, jobs, file_timeout,
+                      exam_args.get('verbose', 0),
+                      preload = ExamTest.allowed_modules, lookup = lookup,
+                      group_key = group_key)
+    for (path, mark, msg, record) in batch.run():
+        print(str(mark) + '|' + msg, flush = True)
+        if writer is not None and path not in done:
+            writer.write(path, mark, msg, record)
+    if writer is not None:
+        writer.close()
+
+def serve(port = None, socket_path = None, jobs = None, queue_size = 100,
+          file_timeout = None, **exam_args):
+    # a marking service (see MarkingServer), with the same warm
+    # template process as batch marking
+    def mark_one(filepath):
+        return mark_file(filepath, **exam_args)
+    server = MarkingServer(mark_one, jobs, queue_size, file_timeout,
+                           exam_args.get('verbose', 0),
+                           preload = ExamTest.allowed_modules)
+    server.serve(port = port, path = socket_path)
+
+def calibrate(path, generated = False):
+    # time-outs from the reference solution's run time on this host
+    # (for the generated stage too, if it is used)
+    import q5
+    stage_tests = ExamTest.stage_tests
+    if generated:
+        stage_tests = stage_tests + \
+            (tuple([ExamTest.generated_test(spec) for spec in ExamTest.test_generated]),)
+    calibration = TimeoutCalibration(q5.peaks_valleys, stage_tests)
+    calibration.load_or_measure(path)
+    return calibration
+
+def check_batch(paths):
+    # static checks only (parse, structure, imports), before marking
+    for path in paths:
+        ok, stage, msg = ExamTest(path, raise_exceptions = False).test_CHECK()
+        print(str(int(ok)) + '|' + msg, flush = True)
+
 ## To produce less verbose output, change verbose from 3 to 2 or 1:
 #ExamTest("homework5.py", verbose = 3).run()
 
@@ -78,12 +327,108 @@ if __name__ == '__main__':
                         dest="exceptions", help="raise exception on first error")
     parser.add_argument('--timeout', type=int, default=10,
                         help="Time-out in seconds for marking script")
-    parser.add_argument('file', type=str, nargs=1, help="file to test")
+    parser.add_argument('--case-timeout', type=float, default=None,
+                        dest="case_timeout",
+                        help="Time-out in seconds for each test case (default: none, "
+                        "only the time-out for each stage applies)")
+    parser.add_argument('--calibration', type=str, default=None,
+                        help="file of reference solution run times on each host; "
+                        "if given, time-outs are set from the times on this host "
+                        "(which are measured first if not in the file)")
+    parser.add_argument('--complexity', action='store_true', dest="complexity",
+                        help="add a stage comparing how the function's run time "
+                        "grows with input size to the reference solution's")
+    parser.add_argument('--generated', action='store_true', dest="generated",
+                        help="add a stage of large generated test cases "
+                        "(requires numpy)")
+    parser.add_argument('--parallel-stages', type=int, default=1,
+                        dest="parallel_stages",
+                        help="number of test stages to run at the same time "
+                        "(each in its own process, with its own time-out)")
+    parser.add_argument('--instrument', action='store_true', dest="instrument",
+                        help="record wall time, CPU time and peak memory allocated "
+                        "for each test case (in the --jsonl records)")
+    parser.add_argument('--fail-fast', type=int, default=None, dest="fail_fast",
+                        help="stop a stage after this many consecutive test cases "
+                        "fail with the same error; the rest fail with it too")
+    parser.add_argument('--differential', action='store_true', dest="differential",
+                        help="add a stage comparing the function to the reference "
+                        "solution on random inputs, for about a second "
+                        "(requires numpy)")
+    parser.add_argument('--batch', '-b', action='store_true',
+                        dest="batch", help="mark every .py file in a directory, "
+                        "or every file matching a glob pattern; prints one "
+                        "line per file, in sorted file name order")
+    parser.add_argument('--check', action='store_true', dest="check",
+                        help="in batch mode, only parse and check every file "
+                        "(structure and imports) and print 1|ok or 0|error per file")
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help="number of worker processes for batch marking "
+                        "(default: number of CPUs)")
+    parser.add_argument('--file-timeout', type=int, default=300,
+                        dest="file_timeout",
+                        help="Time-out in seconds for marking one file in batch mode")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="directory for caching results of identical submissions")
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        dest="cache_size",
+                        help="maximum number of cached results")
+    parser.add_argument('--dedup', action='store_true', dest="dedup",
+                        help="in batch mode, mark only one of each group of files "
+                        "that differ only in layout, comments, docstrings or "
+                        "local variable names")
+    parser.add_argument('--jsonl', type=str, default=None,
+                        help="also write a JSON record (with stage and test case "
+                        "results) for each file to this file, one per line; in "
+                        "batch mode, files already recorded there are skipped")
+    parser.add_argument('--serve', action='store_true', dest="serve",
+                        help="run a marking service instead (POST a submission "
+                        "to /mark; see MarkingServer), until SIGTERM or SIGINT")
+    parser.add_argument('--port', type=int, default=8765,
+                        help="localhost port for --serve")
+    parser.add_argument('--socket', type=str, default=None,
+                        help="Unix socket path for --serve (instead of a port)")
+    parser.add_argument('--queue-size', type=int, default=100, dest="queue_size",
+                        help="number of submissions --serve queues before it "
+                        "refuses more")
+    parser.add_argument('file', type=str, nargs='?', help="file to test")
     args = parser.parse_args()
+    if args.file is None and not args.serve:
+        parser.error("the following arguments are required: file")
+
+    cache = None
+    if args.cache is not None:
+        cache = ResultCache(args.cache, max_entries = args.cache_size)
 
 #    if args.test:
 #        ExamTest(args.file[0], raise_exceptions = args.exceptions,
 #                      verbose = args.verbosity).run()
 #    else:
-    ExamTest(args.file[0], raise_exceptions = args.exceptions,
-                      verbose = args.verbosity, timeout = args.timeout).mark()
+    calibration = None
+    if args.calibration is not None:
+        calibration = calibrate(args.calibration, args.generated)
+
+    exam_args = dict(raise_exceptions = args.exceptions, verbose = args.verbosity,
+                     timeout = args.timeout, case_timeout = args.case_timeout,
+                     cache = cache, calibration = calibration,
+                     complexity = args.complexity, generated = args.generated,
+                     parallel_stages = args.parallel_stages,
+                     instrument = args.instrument, fail_fast = args.fail_fast,
+                     differential = args.differential)
+    if args.serve:
+        serve(args.port, args.socket, jobs = args.jobs, queue_size = args.queue_size,
+              file_timeout = args.file_timeout, **exam_args)
+    elif args.batch and args.check:
+        check_batch(BatchTest.find_files(args.file))
+    elif args.batch:
+        mark_batch(BatchTest.find_files(args.file), jobs = args.jobs,
+                   file_timeout = args.file_timeout, dedup = args.dedup,
+                   jsonl = args.jsonl, **exam_args)
+    elif args.jsonl is not None:
+        mark, msg, record = mark_file(args.file, **exam_args)
+        print(str(mark) + '|' + msg)
+        writer = JSONResultWriter(args.jsonl)
+        writer.write(args.file, mark, msg, record)
+        writer.close()
+    else:
+        ExamTest(args.file, **exam_args).mark()
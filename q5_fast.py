@@ -0,0 +1,177 @@
+# Further versions of peaks_valleys (streaming, multi-core and running
+# counts), kept out of q5.py so that the reference solution only imports
+# the modules a submission may import
+
+from q5 import peaks_valleys, peaks_valleys_array
+
+def peaks_valleys_iter(iterable):
+     # any iterable (e.g., a generator), in constant memory
+     it = iter(iterable)
+     try:
+          a = next(it)
+          b = next(it)
+     except StopIteration:
+          return 0
+     count = 0
+     for c in it:
+          if a < b > c:
+               count += 1
+          elif a > b < c:
+               count += 1
+          a, b = b, c
+     return count
+
+def peaks_valleys_chunks(chunks):
+     # an iterable of consecutive chunks (NumPy arrays or sequences) of
+     # one sequence; only the last two elements are kept from one
+     # chunk to the next, and elements at the seams are counted once
+     count = 0
+     tail = None
+     for chunk in chunks:
+          if hasattr(chunk, 'ndim'):
+               import numpy as np
+               if tail is not None:
+                    chunk = np.concatenate((np.asarray(tail), chunk))
+               count += peaks_valleys_array(chunk)
+          else:
+               if tail is not None:
+                    chunk = list(tail) + list(chunk)
+               count += peaks_valleys(chunk)
+          # the last element of this chunk is not counted yet
+          tail = chunk[-2:]
+     return count
+
+def file_chunks(path, dtype, chunk_size = 1 << 20):
+     # chunks of a raw binary file of dtype values, for peaks_valleys_chunks
+     import numpy as np
+     with open(path, 'rb') as f:
+          while True:
+               chunk = np.fromfile(f, dtype = dtype, count = chunk_size)
+               if chunk.size == 0:
+                    break
+               yield chunk
+
+def _attach_source(source):
+     # source describes where the whole sequence is: ('shm', name,
+     # dtype, size) for shared memory, or ('file', path, dtype, size)
+     # for a raw binary file, which is memory-mapped
+     import numpy as np
+     kind, where, dtype, size = source
+     if kind == 'file':
+          return None, np.memmap(where, dtype = dtype, mode = 'r', shape = (size,))
+     from multiprocessing import shared_memory
+     # (pool processes share the parent's resource tracker, so the
+     # segment stays registered once, and is removed by the parent)
+     shm = shared_memory.SharedMemory(name = where)
+     return shm, np.ndarray((size,), dtype = dtype, buffer = shm.buf)
+
+def _count_part(source, lo, hi):
+     # count the peaks and valleys at positions lo..hi-1, looking one
+     # element past each end so chunk seams are handled exactly
+     shm, a = _attach_source(source)
+     try:
+          return peaks_valleys_array(a[max(lo - 1, 0):min(hi + 1, len(a))])
+     finally:
+          del a
+          if shm is not None:
+               shm.close()
+
+def _count_parts(source, size, processes, parts_per_process):
+     import multiprocessing
+     if processes is None:
+          processes = multiprocessing.cpu_count()
+     n_parts = max(1, min(processes * parts_per_process, size // 3))
+     bounds = [size * k // n_parts for k in range(n_parts + 1)]
+     tasks = [(source, bounds[k], bounds[k + 1]) for k in range(n_parts)]
+     with multiprocessing.Pool(processes) as pool:
+          return sum(pool.starmap(_count_part, tasks))
+
+def peaks_valleys_parallel(seq, processes = None, parts_per_process = 4):
+     # multi-core version: the sequence is copied once into shared
+     # memory, and parts of it are counted by a pool of processes
+     import numpy as np
+     from multiprocessing import shared_memory
+     a = np.asarray(seq)
+     if a.size < 3:
+          return 0
+     shm = shared_memory.SharedMemory(create = True, size = a.nbytes)
+     try:
+          shared = np.ndarray(a.shape, dtype = a.dtype, buffer = shm.buf)
+          shared[:] = a
+          del shared
+          source = ('shm', shm.name, a.dtype.str, a.size)
+          return _count_parts(source, a.size, processes, parts_per_process)
+     finally:
+          shm.close()
+          shm.unlink()
+
+def peaks_valleys_file_parallel(path, dtype, processes = None, parts_per_process = 4):
+     # multi-core version for a raw binary file of dtype values; each
+     # process memory-maps the file, so nothing is copied
+     import numpy as np
+     import os
+     dtype = np.dtype(dtype)
+     size = os.path.getsize(path) // dtype.itemsize
+     if size < 3:
+          return 0
+     return _count_parts(('file', path, dtype.str, size), size, processes,
+                         parts_per_process)
+
+class PeaksValleysCounter:
+     # Running count of peaks and valleys of a sequence that grows by
+     # appending, in O(1) per sample. With a window size, only the last
+     # window samples are counted (the oldest is dropped on each append
+     # past that), and count is always peaks_valleys(last window samples).
+     __slots__ = ('count', 'size', 'window', 'samples', 'prev', 'last')
+
+     def __init__(self, samples = (), window = None):
+          self.count = 0
+          self.size = 0
+          self.window = window
+          self.samples = None
+          if window is not None:
+               import collections
+               self.samples = collections.deque()
+          self.prev = None
+          self.last = None
+          self.extend(samples)
+
+     def append(self, x):
+          if self.size >= 2:
+               if self.prev < self.last > x or self.prev > self.last < x:
+                    self.count += 1
+          self.prev, self.last = self.last, x
+          self.size += 1
+          if self.samples is not None:
+               self.samples.append(x)
+               if self.size > self.window:
+                    self._drop_oldest()
+
+     def _drop_oldest(self):
+          # the second oldest sample stops being an interior point
+          s = self.samples
+          if self.size >= 3:
+               if s[0] < s[1] > s[2] or s[0] > s[1] < s[2]:
+                    self.count -= 1
+          s.popleft()
+          self.size -= 1
+
+     def extend(self, samples):
+          if self.samples is None and hasattr(samples, 'ndim'):
+               # NumPy array: count the whole batch at once
+               if len(samples) == 0:
+                    return
+               import numpy as np
+               if self.size > 0:
+                    head = [self.last] if self.size == 1 else [self.prev, self.last]
+                    joined = np.concatenate((np.asarray(head), samples))
+               else:
+                    joined = samples
+               self.count += peaks_valleys_array(joined)
+               self.size += len(samples)
+               if len(joined) >= 2:
+                    self.prev = joined[-2]
+               self.last = joined[-1]
+               return
+          for x in samples:
+               self.append(x)
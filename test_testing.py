@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Tests of the marking harness (testing.py); run with python -m pytest
+
+from testing import ModuleTestBase, FunctionTestBase, StagedTest
+
+import testing
+
+import builtins
+
+import pytest
+
+class GuardedTest (ModuleTestBase):
+
+    allowed_modules = ['math']
+
+    ## end class GuardedTest
+
+def load_function(directory, source, name = "f"):
+    path = directory / "submission.py"
+    path.write_text(source)
+    test = GuardedTest(str(path), raise_exceptions = False)
+    ok, fun, msg = test.find_function(name)
+    assert ok and fun is not None, msg
+    return test, fun
+
+@pytest.mark.parametrize("call", ["__import__('os')",
+                                  "__import__('os', {})",
+                                  "__import__('os', {'__name__': 'math'})",
+                                  "__import__('os', globals = {})"])
+def test_import_guard_checks_the_caller(tmp_path, call):
+    # the globals passed to __import__ must not decide whose import it is
+    test, fun = load_function(tmp_path, "def f():\n    return " + call + "\n")
+    try:
+        with pytest.raises(ImportError):
+            fun()
+    finally:
+        test.cleanup()
+
+def test_import_guard_allows_allowed_modules(tmp_path):
+    test, fun = load_function(tmp_path, "def f():\n    import math\n"
+                                        "    return __import__('math', {}).pi\n")
+    try:
+        assert fun() > 3
+        # imports by anyone else are not checked
+        assert __import__('os', {}).sep is not None
+    finally:
+        test.cleanup()
+
+@pytest.mark.parametrize("call", ["__import__.original_import('os')",
+                                  "__import__.__self__.original_import('os')"])
+def test_import_hook_hides_the_original_import(tmp_path, call):
+    test, fun = load_function(tmp_path, "def f():\n    return " + call + "\n")
+    try:
+        with pytest.raises(AttributeError):
+            fun()
+    finally:
+        test.cleanup()
+
+def test_import_guards_do_not_stack(tmp_path):
+    original_import = builtins.__import__
+    tests = [load_function(tmp_path, "def f():\n    return 1\n")[0]]
+    hook = builtins.__import__
+    assert hook is not original_import
+    for k in range(4):
+        tests.append(load_function(tmp_path, "def f():\n    return 1\n")[0])
+        assert builtins.__import__ is hook
+    for test in tests:
+        test.cleanup()
+    assert builtins.__import__ is original_import
+
+def test_sandbox_hides_the_disabled_builtins(tmp_path):
+    # in a stage process, after pre_test_run
+    test, fun = load_function(tmp_path,
+        "def f(path):\n"
+        "    try:\n"
+        "        return __import__.disabled['open'](path).read()\n"
+        "    except AttributeError:\n"
+        "        pass\n"
+        "    try:\n"
+        "        return open(path).read()\n"
+        "    except TypeError:\n"
+        "        return 'blocked'\n")
+    try:
+        stage = FunctionTestBase(fun, (((__file__,), 'blocked'),),
+                                 raise_exceptions = False, suppress_output = True)
+        st = StagedTest((stage,), raise_exceptions = False, timeout = 10)
+        st.module_test = test
+        ok, msg = st.run()
+        assert ok, st.details
+    finally:
+        test.cleanup()
+
+def test_test_vectors_in_a_sandboxed_stage(tmp_path):
+    np = pytest.importorskip("numpy")
+    np.save(str(tmp_path / "a.npy"), np.arange(10))
+    testing.TestVector.save_raw(str(tmp_path / "b.raw"), dict(b = np.arange(5, dtype = np.int32)))
+    test, fun = load_function(tmp_path, "def f(seq):\n    return int(sum(seq))\n")
+    try:
+        tests = (((testing.TestVector(str(tmp_path / "a.npy")),), 45),
+                 ((testing.TestVector(str(tmp_path / "b.raw"), "b", as_list = True),), 10))
+        stage = FunctionTestBase(fun, tests, raise_exceptions = False,
+                                 suppress_output = True)
+        st = StagedTest((stage,), raise_exceptions = False, timeout = 10)
+        st.module_test = test
+        ok, msg = st.run()
+        assert ok, st.details
+    finally:
+        test.cleanup()
@@ -4,13 +4,27 @@
 ## Do NOT open, run, modify, move or delete this file.
 
 import sys
+import builtins
 import os.path
 import importlib
 import importlib.machinery
+import importlib.util
 import ast
 import io
+import glob
+import time
+import hashlib
+import json
+import tempfile
+import signal
+import tracemalloc
+import reprlib
+import pickle
+import copy
+import shutil
 
 import multiprocessing
+import multiprocessing.connection
 
 class ModuleTestBase (object):
     STAGE_READ = 1
@@ -24,6 +38,20 @@ class ModuleTestBase (object):
     allowed_modules = None
     forbidden_modules = None
 
+    # a ResultCache, or None for no caching
+    cache = None
+
+    # names of the modules the tests use (e.g., a reference solution):
+    # their source is part of the cache key
+    reference_modules = ()
+
+    # the test tables, in stage order; the files of any TestVector in
+    # them are part of the cache key
+    stage_tests = ()
+
+    # the ImportGuard checking the submission's imports, once loaded
+    import_guard = None
+
     def __init__(self, arg1, verbose = 0, raise_exceptions = True):
         self.raise_exceptions = raise_exceptions
         self.verbose = verbose
@@ -79,30 +107,32 @@ class ModuleTestBase (object):
                 return True
         return False
 
-    def _check_ast(self, warn_only = False):
+    def _check_static(self, warn_only = False, allowed = None, forbidden = None):
+        '''Checks, in one pass over the tree, that the top-level
+        statements are of the allowed types (only warning about the
+        others if warn_only), and, if allowed or forbidden is given,
+        that every import statement (at any depth) uses an allowed
+        module. Returns (ok, stage, msg).'''
         assert(isinstance(self.ast, ast.Module))
-        for item in ast.iter_child_nodes(self.ast):
-            if self._check_ast_exception(item):
-                continue
-            elif type(item) not in self.allowed:
-                if warn_only:
-                    self.warnings.append((item.__class__.__name__ + " ignored",
-                                          self.name + ", line " + str(item.lineno)))
-                else:
-                    msg = self.name + ", line " + str(item.lineno) + " : " \
-                          + item.__class__.__name__ + " is not allowed" + \
-                          "\n(only import statements and function definitions)"
-                    if self.raise_exceptions:
-                        raise Exception(msg)
+        check_imports = allowed is not None or forbidden is not None
+        ast_msg = None
+        violations = []
+        # depth-first, in source order
+        stack = [(item, True) for item in
+                 reversed(list(ast.iter_child_nodes(self.ast)))]
+        while len(stack) > 0:
+            item, top_level = stack.pop()
+            if top_level and ast_msg is None:
+                if self._check_ast_exception(item):
+                    pass
+                elif type(item) not in self.allowed:
+                    if warn_only:
+                        self.warnings.append((item.__class__.__name__ + " ignored",
+                                              self.name + ", line " + str(item.lineno)))
                     else:
-                        return False, self.STAGE_CHECK, msg
-        self.stage = self.STAGE_CHECK
-        return True, self.STAGE_CHECK, "ast check ok"
-
-    def _recursive_check_imports(self, node, allowed, forbidden):
-        msg = ""
-        ok = True
-        for item in ast.iter_child_nodes(node):
+                        ast_msg = self.name + ", line " + str(item.lineno) + " : " \
+                                  + item.__class__.__name__ + " is not allowed" + \
+                                  "\n(only import statements and function definitions)"
             if type(item) == ast.Import:
                 assert hasattr(item, 'names')
                 assert isinstance(item.names, list)
@@ -110,60 +140,37 @@ class ModuleTestBase (object):
                 for alias in item.names:
                     assert hasattr(alias, 'name')
                     assert isinstance(alias.name, str)
-                    if allowed is not None:
-                        if alias.name not in allowed:
-                            if len(msg) > 0:
-                                msg += "; "
-                            msg += self.name + ", line " + str(item.lineno) \
-                                   + " : " + " use of module " + alias.name \
-                                   + " is not allowed"
-                            ok = False
-                    if forbidden is not None:
-                        if alias.name in forbidden:
-                            if len(msg) > 0:
-                                msg += "; "
-                            msg += self.name + ", line " + str(item.lineno) \
-                                   + " : " + " use of module " + alias.name \
-                                   + " is not allowed"
-                            ok = False
+                    if allowed is not None and alias.name not in allowed:
+                        violations.append((item.lineno, alias.name))
+                    if forbidden is not None and alias.name in forbidden:
+                        violations.append((item.lineno, alias.name))
             elif type(item) == ast.ImportFrom:
                 assert hasattr(item, 'module')
                 assert isinstance(item.module, str)
-                if allowed is not None:
-                    if item.module not in allowed:
-                        if len(msg) > 0:
-                            msg += "; "
-                        msg += self.name + ", line " + str(item.lineno) \
-                               + " : " + " use of module " + item.module \
-                               + " is not allowed"
-                        ok = False
-                if forbidden is not None:
-                    if item.module in forbidden:
-                        if len(msg) > 0:
-                            msg += "; "
-                        msg += self.name + ", line " + str(item.lineno) \
-                               + " : " + " use of module " + item.module \
-                               + " is not allowed"
-                        ok = False
+                if allowed is not None and item.module not in allowed:
+                    violations.append((item.lineno, item.module))
+                if forbidden is not None and item.module in forbidden:
+                    violations.append((item.lineno, item.module))
             else:
-                r_ok, r_msg = self._recursive_check_imports(item, allowed, forbidden)
-                if not r_ok:
-                    if len(msg) > 0:
-                        msg += "; "
-                    msg += r_msg
-                ok = ok & r_ok
-        return ok, msg
-
-    def _check_imports(self, allowed = None, forbidden = None):
-        assert(isinstance(self.ast, ast.Module))
-        ok, msg = self._recursive_check_imports(self.ast, allowed, forbidden)
-        if not ok:
+                stack.extend([(child, False) for child in
+                              reversed(list(ast.iter_child_nodes(item)))])
+        if ast_msg is not None:
+            if self.raise_exceptions:
+                raise Exception(ast_msg)
+            else:
+                return False, self.STAGE_CHECK, ast_msg
+        if len(violations) > 0:
+            msg = "; ".join([self.name + ", line " + str(lineno) + " : " +
+                             " use of module " + mod_name + " is not allowed"
+                             for (lineno, mod_name) in violations])
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
                 return False, self.STAGE_CHECK, msg
         self.stage = self.STAGE_CHECK
-        return True, self.STAGE_CHECK, "import check ok"
+        if check_imports:
+            return True, self.STAGE_CHECK, "import check ok"
+        return True, self.STAGE_CHECK, "ast check ok"
 
     def _load_file(self):
         assert(isinstance(self.filepath, str))
@@ -179,7 +186,7 @@ class ModuleTestBase (object):
         self.stage = self.STAGE_LOAD
         return True, self.STAGE_LOAD, "load ok"
 
-    def _load_functions(self):
+    def _filter_functions(self):
         assert (isinstance(self.ast, ast.Module))
         statements = []
         for child_node in ast.iter_child_nodes(self.ast):
@@ -190,9 +197,20 @@ class ModuleTestBase (object):
             elif isinstance(child_node, ast.ImportFrom):
                 statements.append(child_node)
         self.filtered_module = ast.Module(body=statements, type_ignores=[])
+
+    def _load_functions(self):
+        self._filter_functions()
         code = compile(self.filtered_module, '<ast>', 'exec')
         self.module = {}
-        exec(code, self.module)
+        self._guard_imports()
+        try:
+            exec(code, self.module)
+        except ImportError as exc:
+            if self.raise_exceptions:
+                raise exc
+            else:
+                return False, self.STAGE_LOAD, "error " + str(exc) + \
+                    " loading " + self.name
         self.stage = self.STAGE_LOAD
         return True, self.STAGE_LOAD, "load ok"
 
@@ -209,14 +227,8 @@ class ModuleTestBase (object):
             (ok, stage, msg) = self._parse_file()
             if not ok:
                 return False, stage, msg
-        (ok, stage, msg) = self._check_ast(warn_only = True)
-        assert ok
-        if ok:
-            if self.allowed_modules is not None or \
-               self.forbidden_modules is not None:
-                (ok, stage, msg) = self._check_imports(self.allowed_modules,
-                                                       self.forbidden_modules)
-        return ok, stage, msg
+        return self._check_static(True, self.allowed_modules,
+                                  self.forbidden_modules)
 
     def run(self):
         return self.test_LOAD()
@@ -237,21 +249,24 @@ class ModuleTestBase (object):
                 " but it is not a function"
         return True, fun, "ok"
 
-    def pre_test_run(self):
-        for name in self.allowed_modules:
-            mod = importlib.import_module(name)
-        for name, mod in sys.modules.items():
-            mod.__loader__ = None
+    def _guard_imports(self):
+        # check imports made by the submission's code (at load time, and
+        # when its functions run) against allowed_modules/forbidden_modules
+        if self.import_guard is None:
+            self.import_guard = ImportGuard(self.allowed_modules,
+                                            self.forbidden_modules)
+        self.import_guard.guard(self.module)
 
     def pre_test_run(self):
-        for name in self.allowed_modules:
-            mod = importlib.import_module(name)
-        for name, mod in sys.modules.items():
-            mod.__loader__ = None
-        sys.modules['builtins'].open = None
-        sys.modules['builtins'].compile = None
-        sys.modules['builtins'].eval = None
-        sys.modules['builtins'].exec = None
+        # allowed modules are not imported here: the import guard lets
+        # the submission import them (only) when it needs them
+        if self.module is not None:
+            self._guard_imports()
+        elif self.import_guard is None:
+            self.import_guard = ImportGuard(self.allowed_modules,
+                                            self.forbidden_modules)
+        # sets builtins open, compile, eval and exec to None
+        self.import_guard.sandbox(('open', 'compile', 'eval', 'exec'))
         # __builtins__.open = None
         # __builtins__.compile = None
         # __builtins__.eval = None
@@ -260,9 +275,637 @@ class ModuleTestBase (object):
     def cleanup(self):
         if '_test_mod' in sys.modules:
             sys.modules.pop('_test_mod')
+        if self.import_guard is not None and self.module is not None:
+            self.import_guard.unguard(self.module)
+
+    # Result caching: the key is a hash of the submission source plus
+    # a fingerprint of everything else that the result depends on.
+    # Subclasses should extend cache_settings with any run-time setting
+    # (e.g., a timeout) that can change the result.
+    def cache_settings(self):
+        return (self.__class__.__name__, self.allowed_modules,
+                self.forbidden_modules)
+
+    @staticmethod
+    def _module_path(mod_name):
+        # the source file of a module, without importing it if it has
+        # not been imported yet
+        if mod_name in sys.modules:
+            return getattr(sys.modules[mod_name], '__file__', None)
+        try:
+            spec = importlib.util.find_spec(mod_name)
+        except (ImportError, ValueError):
+            return None
+        if spec is None or not spec.has_location:
+            return None
+        return spec.origin
+
+    def suite_fingerprint(self):
+        h = hashlib.sha256()
+        # the testing module, the module defining the test class
+        # (with its test tables and mark computation) and the
+        # reference modules
+        for mod_name in (__name__, self.__class__.__module__) + \
+                tuple(self.reference_modules):
+            path = self._module_path(mod_name)
+            if path is not None:
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+        h.update(repr(self.cache_settings()).encode('utf-8'))
+        h.update(repr(vector_stamps(self.stage_tests)).encode('utf-8'))
+        return h.hexdigest()
+
+    def cache_key(self):
+        assert(isinstance(self.filepath, str))
+        with open(self.filepath, 'rb') as f:
+            source = f.read()
+        h = hashlib.sha256(source)
+        h.update(self.suite_fingerprint().encode('ascii'))
+        return h.hexdigest()
+
+    def normalised_fingerprint(self):
+        '''Hash of the filtered module (as loaded by _load_functions)
+        with docstrings removed and local variables renamed, so that
+        submissions differing only in layout, comments, docstrings or
+        local variable names get the same fingerprint. Returns None if
+        the submission does not pass test_CHECK (its messages may then
+        depend on line numbers).'''
+        if self.stage < self.STAGE_CHECK:
+            raise_exceptions = self.raise_exceptions
+            self.raise_exceptions = False
+            try:
+                (ok, stage, msg) = self.test_CHECK()
+            finally:
+                self.raise_exceptions = raise_exceptions
+            if not ok:
+                return None
+        self._filter_functions()
+        tree = ASTNormaliser().normalise(self.filtered_module)
+        return hashlib.sha256(ast.dump(tree).encode('utf-8')).hexdigest()
+
+    # stand-ins for the submission's path and file name in cached
+    # results, which are shared by identical files of any name
+    cache_path_token = "\x00path\x00"
+    cache_name_token = "\x00name\x00"
+
+    @staticmethod
+    def _replace_in_result(result, pairs):
+        # result (mark, msg, record) with each (old, new) of pairs
+        # replaced in msg and in the (JSON) record, in order
+        mark, msg, record = result
+        for (old, new) in pairs:
+            msg = msg.replace(old, new)
+        if record is not None:
+            text = json.dumps(record)
+            for (old, new) in pairs:
+                text = text.replace(json.dumps(old)[1:-1], json.dumps(new)[1:-1])
+            record = json.loads(text)
+        return mark, msg, record
+
+    def cached_result(self):
+        '''Return the cached (mark, msg, record) for this submission, or
+        None; record is the stored result record, or None.'''
+        if self.cache is None or self.filepath is None:
+            return None
+        try:
+            key = self.cache_key()
+        except OSError:
+            return None
+        result = self.cache.get(key)
+        if result is None:
+            return None
+        return self._replace_in_result(result,
+                                       ((self.cache_path_token, self.filepath),
+                                        (self.cache_name_token, self.name)))
+
+    def store_result(self, mark, msg, record = None):
+        if self.cache is None or self.filepath is None:
+            return
+        try:
+            key = self.cache_key()
+        except OSError:
+            return
+        mark, msg, record = self._replace_in_result((mark, msg, record),
+                                                    ((self.filepath, self.cache_path_token),
+                                                     (self.name, self.cache_name_token)))
+        self.cache.put(key, mark, msg, record)
 
     ## end class ModuleTestBase
 
+def _make_import_hook():
+    # the hook that ImportGuard installs as builtins.__import__, and the
+    # functions controlling it; the original __import__ and the disabled
+    # builtins are kept only in this closure, not as attributes of the
+    # hook, which code calling __import__ can see
+    original_import = builtins.__import__
+    # id(namespace) -> (namespace, guard)
+    guarded = dict()
+    # builtins disabled by sandbox, by name
+    disabled = dict()
+    state = dict(sandboxed = False, loading = 0, n_modules = 0)
+
+    def clear_loaders():
+        # remove __loader__ from modules loaded since the last call
+        if len(sys.modules) != state['n_modules']:
+            for mod in list(sys.modules.values()):
+                if mod is not None:
+                    mod.__loader__ = None
+            state['n_modules'] = len(sys.modules)
+
+    def guarded_import(name, globals = None, locals = None, fromlist = (), level = 0):
+        # the caller is found from its frame: the globals argument is
+        # whatever the caller passes (e.g., __import__('os', {}))
+        entry = guarded.get(id(sys._getframe(1).f_globals))
+        if entry is not None and not entry[1].is_allowed(name, level):
+            raise ImportError("use of module " + name + " is not allowed")
+        if not state['sandboxed'] or (name in sys.modules and not fromlist):
+            return original_import(name, globals, locals, fromlist, level)
+        # loading a module (for the submission, or for the harness in
+        # a sandboxed stage process) may need the disabled builtins
+        # (imports nest: only the outermost one disables them again)
+        for (builtin_name, value) in disabled.items():
+            setattr(builtins, builtin_name, value)
+        state['loading'] += 1
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            state['loading'] -= 1
+            if state['loading'] == 0:
+                for builtin_name in disabled:
+                    setattr(builtins, builtin_name, None)
+                clear_loaders()
+
+    def guard(namespace, import_guard):
+        guarded[id(namespace)] = (namespace, import_guard)
+        builtins.__import__ = guarded_import
+
+    def unguard(namespace):
+        guarded.pop(id(namespace), None)
+        # (the hook stays while sandboxed, to load modules)
+        if len(guarded) == 0 and not state['sandboxed'] and \
+           builtins.__import__ is guarded_import:
+            builtins.__import__ = original_import
+
+    def sandbox(names):
+        for name in names:
+            if getattr(builtins, name) is not None:
+                disabled[name] = getattr(builtins, name)
+            setattr(builtins, name, None)
+        state['sandboxed'] = True
+        builtins.__import__ = guarded_import
+        clear_loaders()
+
+    return guard, unguard, sandbox
+
+_guard_namespace, _unguard_namespace, _sandbox_builtins = _make_import_hook()
+
+class ImportGuard:
+    '''Checks the imports made by code in the guarded namespaces (the
+    submission's globals) against an allow list and/or a block list of
+    module names, by the same rule as the static import check; any
+    other import (by the harness, or by an allowed module importing its
+    own dependencies) is passed on as it is. So modules are only loaded
+    when the submission imports them, and imports the static check
+    can't see (e.g., __import__ calls) fail with ImportError when run.
+
+    All guards share one hook (a plain function), installed as
+    builtins.__import__ while any namespace is guarded, so guarding
+    many submissions in one process does not stack hooks; unguard (see
+    ModuleTestBase.cleanup) drops a namespace. Once sandboxed (by
+    pre_test_run), the disabled builtins are given back only while a
+    module is being loaded, and the modules loaded then have their
+    __loader__ removed, as for all modules loaded before. The original
+    __import__ and the disabled builtins are not attributes of the
+    hook; but code that can inspect function closures can still reach
+    them, so this is a hurdle rather than a boundary.'''
+
+    def __init__(self, allowed = None, forbidden = None):
+        self.allowed = allowed
+        self.forbidden = forbidden
+
+    def guard(self, namespace):
+        if isinstance(namespace, type(sys)):
+            namespace = namespace.__dict__
+        _guard_namespace(namespace, self)
+
+    def unguard(self, namespace):
+        if isinstance(namespace, type(sys)):
+            namespace = namespace.__dict__
+        _unguard_namespace(namespace)
+
+    def is_allowed(self, name, level = 0):
+        if level > 0:
+            return False
+        if self.allowed is not None and name not in self.allowed:
+            return False
+        if self.forbidden is not None and name in self.forbidden:
+            return False
+        return True
+
+    def sandbox(self, names):
+        # disable the named builtins (in this process, for good), and
+        # remove module loaders
+        _sandbox_builtins(names)
+
+    ## end class ImportGuard
+
+class ASTNormaliser (object):
+    '''Rewrites a copy of a module AST so that programs that differ
+    only in docstrings and in the names of local variables become
+    equal (as compared by ast.dump). Only names that appear solely as
+    ast.Name nodes and are assigned in a function, lambda or
+    comprehension scope are renamed; parameters, function names,
+    imported names, globals and attributes are kept, so the
+    normalised tree never equates two programs that behave
+    differently. Renaming is skipped altogether for code using
+    constructs with unusual scoping rules.'''
+
+    scope_types = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda,
+                   ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+    no_rename_types = (ast.ClassDef, ast.Global, ast.Nonlocal,
+                       ast.NamedExpr, getattr(ast, 'Match', ast.ClassDef))
+
+    no_rename_names = ('locals', 'vars', 'dir', 'globals')
+
+    def __init__(self):
+        self.counter = 0
+        self.excluded = set()
+
+    def normalise(self, tree):
+        import copy
+        tree = copy.deepcopy(tree)
+        self._drop_docstrings(tree)
+        for node in ast.walk(tree):
+            if isinstance(node, self.no_rename_types):
+                return tree
+            if isinstance(node, ast.Name) and node.id in self.no_rename_names:
+                return tree
+            # any identifier that is not an ast.Name (def names,
+            # parameters, import aliases, attributes, keywords, ...)
+            # is never renamed
+            for field, value in ast.iter_fields(node):
+                if isinstance(node, ast.Name) and field == 'id':
+                    continue
+                if isinstance(value, str):
+                    self.excluded.add(value)
+                elif isinstance(value, list):
+                    self.excluded.update([v for v in value if isinstance(v, str)])
+                if isinstance(node, ast.alias) and field == 'name':
+                    self.excluded.update(value.split('.'))
+        self._rename_scope(tree, tree.body, dict())
+        return tree
+
+    def _drop_docstrings(self, tree):
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and \
+               len(node.body) > 0 and isinstance(node.body[0], ast.Expr) and \
+               isinstance(node.body[0].value, ast.Constant) and \
+               isinstance(node.body[0].value.value, str):
+                node.body = node.body[1:]
+                if len(node.body) == 0:
+                    node.body = [ast.Pass()]
+
+    def _outer_parts(self, node):
+        # the parts of a scope node that are evaluated in the enclosing scope
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            parts = node.decorator_list + node.args.defaults + \
+                [d for d in node.args.kw_defaults if d is not None]
+            if node.returns is not None:
+                parts.append(node.returns)
+            for arg in node.args.posonlyargs + node.args.args + \
+                node.args.kwonlyargs + [node.args.vararg, node.args.kwarg]:
+                if arg is not None and arg.annotation is not None:
+                    parts.append(arg.annotation)
+            return parts
+        elif isinstance(node, ast.Lambda):
+            return node.args.defaults + \
+                [d for d in node.args.kw_defaults if d is not None]
+        else:
+            return [node.generators[0].iter]
+
+    def _inner_parts(self, node):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            return node.body
+        elif isinstance(node, ast.Lambda):
+            return [node.body]
+        if isinstance(node, ast.DictComp):
+            parts = [node.key, node.value]
+        else:
+            parts = [node.elt]
+        for (i, gen) in enumerate(node.generators):
+            parts.append(gen.target)
+            if i > 0:
+                parts.append(gen.iter)
+            parts.extend(gen.ifs)
+        return parts
+
+    def _scope_nodes(self, roots):
+        # nodes in the scope, in source order, without entering nested
+        # scopes (their outer parts are included; the nested scope
+        # nodes themselves are returned separately)
+        nodes = []
+        nested = []
+        stack = list(reversed(roots))
+        while len(stack) > 0:
+            node = stack.pop()
+            if isinstance(node, self.scope_types):
+                nested.append(node)
+                children = self._outer_parts(node)
+            else:
+                nodes.append(node)
+                children = list(ast.iter_child_nodes(node))
+            stack.extend(reversed(children))
+        return nodes, nested
+
+    def _rename_scope(self, scope, roots, outer_names):
+        nodes, nested = self._scope_nodes(roots)
+        names = dict(outer_names)
+        if not isinstance(scope, ast.Module):
+            for node in nodes:
+                if isinstance(node, ast.Name) and \
+                   not isinstance(node.ctx, ast.Load) and \
+                   node.id not in self.excluded and \
+                   (node.id not in names or names[node.id] == outer_names.get(node.id)):
+                    names[node.id] = '$' + str(self.counter)
+                    self.counter += 1
+        for node in nodes:
+            if isinstance(node, ast.Name) and node.id in names:
+                node.id = names[node.id]
+        for node in nested:
+            self._rename_scope(node, self._inner_parts(node), names)
+
+    ## end class ASTNormaliser
+
+class CaseTimeout (BaseException):
+    # raised by the per-test-case watchdog; derived from BaseException
+    # so "except Exception" in the tested code does not catch it
+    pass
+
+class PreviewRepr (reprlib.Repr):
+    # repr for call strings in messages: the same as repr for
+    # arguments of ordinary size, but with long containers, strings
+    # and numbers cut short (with ...), so a message never costs more
+    # than a preview of the arguments to build, however large they are
+    def __init__(self):
+        reprlib.Repr.__init__(self)
+        self.maxlevel = 20
+        self.maxtuple = self.maxlist = self.maxarray = 100
+        self.maxdict = self.maxset = self.maxfrozenset = self.maxdeque = 100
+        self.maxstring = self.maxlong = self.maxother = 1000
+
+    # (reprlib sorts dicts and sets; keep them in iteration order, as repr does)
+    def repr_dict(self, x, level):
+        if len(x) == 0:
+            return '{}'
+        if level <= 0:
+            return '{...}'
+        items = [self.repr1(key, level - 1) + ': ' + self.repr1(x[key], level - 1)
+                 for key in list(x)[:self.maxdict]]
+        if len(x) > self.maxdict:
+            items.append('...')
+        return '{' + ', '.join(items) + '}'
+
+    def repr_set(self, x, level):
+        if len(x) == 0:
+            return 'set()'
+        return self._repr_iterable(x, level, '{', '}', self.maxset)
+
+    def repr_frozenset(self, x, level):
+        if len(x) == 0:
+            return 'frozenset()'
+        return self._repr_iterable(x, level, 'frozenset({', '})', self.maxfrozenset)
+
+    ## end class PreviewRepr
+
+preview_repr = PreviewRepr().repr
+
+def fingerprint(obj):
+    '''A digest of the value of obj (e.g., a tuple of arguments), to tell
+    if it has been modified, without keeping a copy of it. The digest is
+    of obj pickled, so it is taken at C speed in one pass, and contiguous
+    array buffers are hashed in place. Returns None if obj can't be
+    pickled (and so must be copied to be compared).'''
+    hasher = hashlib.blake2b(digest_size = 16)
+    def write_buffer(buf):
+        hasher.update(buf.raw())
+    try:
+        pickle.Pickler(HashWriter(hasher), protocol = 5,
+                       buffer_callback = write_buffer).dump(obj)
+    except Exception:
+        return None
+    return hasher.digest()
+
+class HashWriter:
+    # a write-only "file" that adds what is written to a hash
+    def __init__(self, hasher):
+        self.write = hasher.update
+
+    ## end class HashWriter
+
+def cheap_copy(obj):
+    # an independent copy of obj, by pickling (much faster than
+    # deepcopy for large lists and arrays), or deepcopy if that fails
+    try:
+        return pickle.loads(pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return copy.deepcopy(obj)
+
+class TestMessage:
+    '''A test case message: the call string of the test, followed by
+    suffix. The call string is only made when the message is first
+    converted to a string (most messages for passed tests never are),
+    and is then kept. When sent to another process, only the text made
+    so far and the suffix are sent; the receiving test object sets
+    itself as owner again (see FunctionTestBase.set_details).'''
+    __slots__ = ('owner', 'index', 'test', 'suffix', 'text')
+
+    def __init__(self, owner, test, suffix, index = None):
+        self.owner = owner
+        self.test = test
+        self.suffix = suffix
+        self.index = index
+        self.text = None
+
+    def __str__(self):
+        if self.text is None:
+            if self.owner is None:
+                return "test #" + str(self.index) + self.suffix
+            test = self.test
+            if test is None:
+                test = self.owner.tests[self.index]
+            self.text = self.owner._call_string(test) + self.suffix
+        return self.text
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __getstate__(self):
+        return (self.index, self.suffix, self.text)
+
+    def __setstate__(self, state):
+        self.index, self.suffix, self.text = state
+        self.owner = None
+        self.test = None
+
+    ## end class TestMessage
+
+def sum_usage(usage):
+    # sum of a list of test case usage dicts (see FunctionTestBase),
+    # skipping None entries; peak_bytes is the largest, not the sum
+    total = dict(wall_ns = 0, cpu_ns = 0, peak_bytes = 0)
+    for case_usage in usage:
+        if case_usage is not None:
+            total['wall_ns'] += case_usage['wall_ns']
+            total['cpu_ns'] += case_usage['cpu_ns']
+            total['peak_bytes'] = max(total['peak_bytes'], case_usage['peak_bytes'])
+    return total
+
+class TestVector:
+    '''A test case argument stored in a binary file, to be used in a test
+    table in place of the argument itself (e.g., ((TestVector("big.npy"),),
+    answer)). path is either a .npy file, or a raw binary file holding
+    several arrays, described by an index file (path + ".index.json",
+    see save_raw), of which name is the one to use. The file is
+    memory-mapped (read only, once per process) when a test using it
+    runs, so large inputs are read from the page cache, and not built
+    in the marking script or sent to stage processes; the function is
+    passed a read-only array view, or with as_list, a list made from it
+    when the test runs. Requires numpy.'''
+
+    # path -> memory map (an array for .npy files, raw bytes otherwise)
+    _maps = dict()
+    # path -> index (of a raw file)
+    _indexes = dict()
+
+    def __init__(self, path, name = None, as_list = False):
+        self.path = path
+        self.name = name
+        self.as_list = as_list
+
+    def __repr__(self):
+        args = [repr(self.path)]
+        if self.name is not None:
+            args.append(repr(self.name))
+        if self.as_list:
+            args.append("as_list=True")
+        return "TestVector(" + ", ".join(args) + ")"
+
+    def _map(self):
+        import numpy as np
+        if self.path not in TestVector._maps:
+            if self.path.endswith('.npy'):
+                TestVector._maps[self.path] = np.load(self.path, mmap_mode = 'r')
+            else:
+                TestVector._maps[self.path] = np.memmap(self.path, dtype = np.uint8,
+                                                        mode = 'r')
+        return TestVector._maps[self.path]
+
+    def array(self):
+        '''The (read-only, memory-mapped) array.'''
+        import numpy as np
+        data = self._map()
+        if self.path.endswith('.npy'):
+            return data
+        entry = TestVector.read_index(self.path)[self.name]
+        dtype = np.dtype(entry['dtype'])
+        count = 1
+        for dim in entry['shape']:
+            count *= dim
+        return np.frombuffer(data, dtype = dtype, count = count,
+                             offset = entry['offset']).reshape(entry['shape'])
+
+    def prepare(self):
+        '''Map the file (and read its index) now, while open can be
+        used: a stage process does this before pre_test_run.'''
+        self._map()
+        if not self.path.endswith('.npy'):
+            TestVector.read_index(self.path)
+
+    def stamp(self):
+        '''The size and modification time of the file (and of its index
+        file), to tell if it has changed since a result was cached.'''
+        stamp = [self.path]
+        paths = [self.path]
+        if not self.path.endswith('.npy'):
+            paths.append(self.path + ".index.json")
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp += [st.st_size, st.st_mtime_ns]
+            except OSError:
+                stamp += [None, None]
+        return tuple(stamp)
+
+    def load(self):
+        if self.as_list:
+            return self.array().tolist()
+        return self.array()
+
+    @staticmethod
+    def read_index(path):
+        if path not in TestVector._indexes:
+            with open(path + ".index.json") as f:
+                TestVector._indexes[path] = json.load(f)
+        return TestVector._indexes[path]
+
+    @staticmethod
+    def save_raw(path, arrays):
+        '''Write a dict of name: array to a raw binary file at path, each
+        array aligned to 64 bytes, with its index (offset, dtype and shape
+        of each array) in path + ".index.json".'''
+        import numpy as np
+        index = dict()
+        offset = 0
+        with open(path, 'wb') as f:
+            for (name, array) in arrays.items():
+                array = np.ascontiguousarray(array)
+                padding = -offset % 64
+                f.write(bytes(padding))
+                offset += padding
+                index[name] = dict(offset = offset, dtype = array.dtype.str,
+                                   shape = list(array.shape))
+                f.write(array.tobytes())
+                offset += array.nbytes
+        with open(path + ".index.json", 'w') as f:
+            json.dump(index, f)
+        TestVector._maps.pop(path, None)
+        TestVector._indexes.pop(path, None)
+
+    ## end class TestVector
+
+def table_vectors(tables):
+    # the TestVector arguments in a sequence of test tables (tables of
+    # other kinds of test, e.g. generated ones, have none)
+    vectors = []
+    for tests in tables:
+        for test in tests:
+            if isinstance(test, tuple) and len(test) > 0 and \
+               isinstance(test[0], (tuple, list)):
+                vectors += [arg for arg in test[0] if isinstance(arg, TestVector)]
+    return vectors
+
+def vector_stamps(tables):
+    # the stamps of the TestVector files used in a sequence of test
+    # tables (see TestVector.stamp)
+    return [vector.stamp() for vector in table_vectors(tables)]
+
+def resolve_args(args):
+    # the arguments of a test case, with any TestVector loaded
+    if not any([isinstance(arg, TestVector) for arg in args]):
+        return args
+    return tuple([arg.load() if isinstance(arg, TestVector) else arg
+                  for arg in args])
+
 class ReadOnlyStringIO (io.StringIO):
 
     def writable(self):
@@ -291,6 +934,21 @@ class FunctionTestBase (object):
         self.type_cast_answer = type_cast_answer
         self.details = None
         self.collate = 0
+        # time limit (seconds) for each test case, or a sequence of
+        # limits, one per test case, or None; report, if set, is
+        # called with each details entry (and its usage) as it is made
+        self.case_timeout = None
+        self.report = None
+        # if instrument is set, usage has an entry for each details
+        # entry: a dict of the test case's wall_ns and cpu_ns (times in
+        # nanoseconds) and peak_bytes (peak memory allocated above what
+        # was allocated before it, traced with tracemalloc); else None
+        self.instrument = False
+        self.usage = None
+        # fail fast: if set to n, after n consecutive test cases have
+        # failed with the same message (after the call string), the rest
+        # are not run, and fail with that message
+        self.fail_fast = None
 
     # Methods _get_test_args and _check_answer can be overridden
     # by subclasses to extend/specialise the definition of a test
@@ -303,19 +961,37 @@ class FunctionTestBase (object):
         return test[0]
 
     def _str_tuple(self, args):
-        return '(' + ', '.join([repr(arg) for arg in args]) + ')'
+        return '(' + ', '.join([preview_repr(arg) for arg in args]) + ')'
 
     def _call_string(self, test):
         return "call " + self.name + self._str_tuple(self._get_test_args(test))
 
+    def _message(self, test, suffix):
+        # the message for a test case, made into a string only when used
+        return TestMessage(self, test, suffix)
+
+    def _fixed_message(self, test, call, suffix):
+        # a message with its call string already made (e.g., before a
+        # call that may modify the arguments it shows)
+        msg = TestMessage(self, test, suffix)
+        msg.text = call + suffix
+        return msg
+
+    def _message_tail(self, index):
+        # the message of test number index, without its call string
+        msg = self.details[index][2]
+        if isinstance(msg, TestMessage):
+            return msg.suffix
+        return msg[len(self._call_string(self.tests[index])):]
+
     def _test_type_ctor(self, test):
         return type(test[1])
 
     def _type_check_answer(self, test, fvalue):
         # special check for no return:
         if type(fvalue) == type(None):
-            msg = self._call_string(test) + \
-                  " did not return any value (missing return statement?)"
+            msg = self._message(test,
+                  " did not return any value (missing return statement?)")
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
@@ -338,21 +1014,21 @@ class FunctionTestBase (object):
             except:
                 pass
             if not ok:
-                msg = self._call_string(test) + \
+                msg = self._message(test,
                       " returned the value " + str(fvalue) + " of type " + \
                       str(type(fvalue)) + \
                       " which could not be converted to the type " + \
                       str(type(test[1])) + " of the expected answer " + \
-                      str(test[1])
+                      str(test[1]))
                 if self.raise_exceptions:
                     raise Exception(msg)
                 else:
                     return False, msg
         # else (type casting not enabled), check return type matches exactly
         elif type(fvalue) != type(test[1]):
-            msg = self._call_string(test) + \
+            msg = self._message(test,
                   " returned incorrect type " + str(type(fvalue)) \
-                  + "; the expected type is " + str(type(test[1]))
+                  + "; the expected type is " + str(type(test[1])))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
@@ -366,39 +1042,103 @@ class FunctionTestBase (object):
         fvalue = result
         # check returned value matches (equal)
         if fvalue != test[1]:
-            msg = self._call_string(test) + \
+            msg = self._message(test,
                   " returned incorrect answer " + str(fvalue) \
-                  + "; the expected answer is " + str(test[1])
+                  + "; the expected answer is " + str(test[1]))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
                 return False, msg
         else:
-            return True, self._call_string(test) + " ok"
+            return True, self._message(test, " ok")
 
     def _run_test(self, test):
-        args = self._get_test_args(test)
+        args = resolve_args(self._get_test_args(test))
         if self.verbose > 1:
             print("calling " + self.name + self._str_tuple(args))
         try:
             fvalue = self.function(*args)
         except Exception as exc:
-            msg = self._call_string(test) + \
-                  " caused " + exc.__class__.__name__ + " " + str(exc)
+            msg = self._message(test,
+                  " caused " + exc.__class__.__name__ + " " + str(exc))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
                 return False, msg
         return self._check_answer(test, fvalue)
 
+    def _on_case_timeout(self, signum, frame):
+        raise CaseTimeout()
+
+    def _get_case_timeout(self, num):
+        if isinstance(self.case_timeout, (list, tuple)):
+            return self.case_timeout[num]
+        return self.case_timeout
+
+    def _run_test_with_timeout(self, test, num):
+        # run one test case with a SIGALRM watchdog, if a case time
+        # limit is set (and signals are usable here: main thread, Unix)
+        case_timeout = self._get_case_timeout(num)
+        if case_timeout is None or not hasattr(signal, 'setitimer'):
+            return self._run_test(test)
+        try:
+            old_handler = signal.signal(signal.SIGALRM, self._on_case_timeout)
+        except ValueError:
+            return self._run_test(test)
+        signal.setitimer(signal.ITIMER_REAL, case_timeout)
+        try:
+            return self._run_test(test)
+        except CaseTimeout:
+            msg = self._message(test, " timed out (time limit " + \
+                  str(case_timeout) + " s)")
+            if self.raise_exceptions:
+                raise Exception(msg)
+            else:
+                return False, msg
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+
+    def set_partial_details(self, details, usage = None):
+        '''Set details from the entries reported before the stage running
+        these tests was stopped; the tests without an entry are failed.'''
+        done = dict([(detail[0], detail) for detail in details])
+        if usage is not None:
+            done_usage = dict([(detail[0], case_usage) for (detail, case_usage)
+                               in zip(details, usage)])
+            usage = [done_usage.get(num) for num in range(len(self.tests))]
+        self.set_details([done.get(num, (num, False, TestMessage(self, None, " timeout", num)))
+                          for num in range(len(self.tests))], usage)
+
+    def set_details(self, details, usage = None):
+        '''Set details (and usage) received from the process that ran
+        these tests.'''
+        for (num, passed, msg) in details:
+            if isinstance(msg, TestMessage) and msg.owner is None:
+                msg.owner = self
+        self.details = details
+        self.usage = usage
+
+    def _run_test_measured(self, test, num):
+        # as _run_test_with_timeout, also returning the case's usage
+        tracemalloc.reset_peak()
+        allocated = tracemalloc.get_traced_memory()[0]
+        cpu_start = time.process_time_ns()
+        wall_start = time.perf_counter_ns()
+        passed, msg = self._run_test_with_timeout(test, num)
+        wall_ns = time.perf_counter_ns() - wall_start
+        cpu_ns = time.process_time_ns() - cpu_start
+        peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - allocated)
+        return passed, msg, dict(wall_ns = wall_ns, cpu_ns = cpu_ns,
+                                 peak_bytes = peak_bytes)
+
     def _group_fails_by_message(self):
         assert self.details is not None
         assert len(self.details) == len(self.tests)
         assert len(self.tests) > 0
         msg_map = dict()
         for index in range(len(self.tests)):
-            call = self._call_string(self.tests[index])
-            msg = self.details[index][2][len(call):]
+            msg = self._message_tail(index)
             if msg not in msg_map:
                 msg_map[msg] = []
             msg_map[msg].append(index)
@@ -410,22 +1150,65 @@ class FunctionTestBase (object):
             ok, fun, msg = self.mod.find_function(self.name)
             if not ok or fun is None:
                 self.details = [(i, False, msg) for i in range(len(self.tests))]
+                self.usage = None
                 return False, msg
             self.function = fun
         n_passed = 0
         self.details = []
+        self.usage = None
+        usage = None
+        if self.instrument:
+            self.usage = []
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
         sys_stdin = sys.stdin
         sys_stdout = sys.stdout
         sys.stdin =  ReadOnlyStringIO('')
         if self.suppress_output:
             sys.stdout =  io.StringIO('')
+        same_fails = 0
+        last_fail = None
         for num, test in enumerate(self.tests):
-            passed, msg = self._run_test(test)
+            if self.instrument:
+                passed, msg, usage = self._run_test_measured(test, num)
+                self.usage.append(usage)
+            else:
+                passed, msg = self._run_test_with_timeout(test, num)
+            if isinstance(msg, TestMessage):
+                # (the call string is made from self.tests[num] if needed,
+                # so the message does not keep generated arguments alive)
+                msg.index = num
+                msg.test = None
             if passed:
                 n_passed += 1
             self.details.append((num, passed, msg))
+            if self.report is not None:
+                self.report((num, passed, msg), usage)
             if self.verbose > 0:
                 print(msg)
+            if self.fail_fast is not None:
+                if passed:
+                    same_fails = 0
+                else:
+                    tail = self._message_tail(num)
+                    if same_fails > 0 and tail == last_fail:
+                        same_fails += 1
+                    else:
+                        same_fails = 1
+                    last_fail = tail
+                    if same_fails >= self.fail_fast:
+                        break
+        # (after a fail-fast stop) the tests not run fail the same way
+        for num in range(len(self.details), len(self.tests)):
+            msg = TestMessage(self, None, last_fail, num)
+            self.details.append((num, False, msg))
+            if self.instrument:
+                self.usage.append(None)
+            if self.report is not None:
+                self.report((num, False, msg), None)
+        if self.instrument and started_tracing:
+            tracemalloc.stop()
         sys.stdin =  sys_stdin
         if self.suppress_output:
             sys.stdout =  sys_stdout
@@ -456,7 +1239,11 @@ class FunctionTestBase (object):
         result.extend([n_passed >= len(self.tests), rmsg])
         return n_passed >= len(self.tests), rmsg
 
-    def total(self):
+    def total(self, resources = False):
+        '''Returns (passed, failed); with resources, (passed, failed,
+        usage), where usage sums wall_ns and cpu_ns over the test cases
+        and has the largest peak_bytes of them (all 0 if the tests were
+        not instrumented).'''
         ## can only be called after tests have run:
         #assert self.details is not None
         passed = 0
@@ -467,7 +1254,9 @@ class FunctionTestBase (object):
                     passed += 1
                 else:
                     failed += 1
-        return passed, failed
+        if not resources:
+            return passed, failed
+        return passed, failed, sum_usage(self.usage or [])
 
     def common_error_msg(self):
         '''This method can only be called after tests have executed.
@@ -479,12 +1268,10 @@ class FunctionTestBase (object):
         n_pass, n_fail = self.total()
         if n_fail < len(self.tests):
             return None # not all tests failed, so no common error
-        # set message from first test as template
-        template_msg = self.details[0][2]
-        # remove the call string from the template message
-        template_msg = template_msg[len(self._call_string(self.tests[0])):]
+        # set message from first test, minus its call string, as template
+        template_msg = self._message_tail(0)
         # count how many messages equal the template, post their call string
-        n_same = sum([self.details[i][2][len(self._call_string(self.tests[i])):] == template_msg for i in range(len(self.tests))])
+        n_same = sum([self._message_tail(i) == template_msg for i in range(len(self.tests))])
         # if it's all, then return the common error message:
         if n_same == len(self.tests):
             return template_msg
@@ -519,16 +1306,16 @@ class FunctionTestWithExplanation (FunctionTestBase):
         fvalue = result
         # check returned value matches (equal)
         if fvalue != test[1]:
-            msg = self._call_string(test) + \
+            msg = self._message(test,
                   " returned incorrect answer " + str(fvalue) \
                   + "; the expected answer is " + str(test[1]) \
-                  + self._make_explanation(test)
+                  + self._make_explanation(test))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
                 return False, msg
         else:
-            return True, self._call_string(test) + " ok"
+            return True, self._message(test, " ok")
 
     ## end class FunctionTestWithExplanation
 
@@ -549,41 +1336,52 @@ class FunctionTestReturningFloat (FunctionTestWithExplanation):
         fvalue = result
         # check returned value matches (to precision):
         if abs(fvalue - test[1]) > self.precision:
-            msg = self._call_string(test) + \
+            msg = self._message(test,
                   " returned incorrect answer " + str(fvalue) \
                   + "; the expected answer is " + str(test[1]) \
                   + self._make_explanation(test) \
-                  + " and the difference is > " + str(self.precision)
+                  + " and the difference is > " + str(self.precision))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
                 return False, msg
         else:
-            return True, self._call_string(test) + " ok"
+            return True, self._message(test, " ok")
 
     ## end class FunctionTestReturningFloat
 
 class FunctionTestOnMutableArgs (FunctionTestWithExplanation):
+    '''Tests that the function does not modify its arguments. The
+    function is called on a copy of the test arguments (see
+    cheap_copy()), which is compared with == to the arguments after
+    the call.'''
 
-    import copy
+    @staticmethod
+    def _modified(args, args1):
+        try:
+            return not (args1 == args)
+        except ValueError:
+            # (e.g., numpy arrays, whose == is elementwise)
+            return fingerprint(args1) != fingerprint(args)
 
     def _run_test(self, test):
-        args = self._get_test_args(test)
-        args1 = self.copy.deepcopy(args)
+        args = resolve_args(self._get_test_args(test))
+        call = self._call_string(test)
+        args1 = cheap_copy(args)
         if self.verbose > 1:
             print("calling " + self.name + self._str_tuple(args))
         try:
             fvalue = self.function(*args1)
         except Exception as exc:
-            msg = self._call_string(test) + \
-                  " caused " + exc.__class__.__name__ + " " + str(exc)
+            msg = self._fixed_message(test, call,
+                  " caused " + exc.__class__.__name__ + " " + str(exc))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
                 return False, msg
-        if not (args1 == args):
-            msg = self._call_string(test) + \
-                  " modified argument(s): " + self._str_tuple(args1)
+        if self._modified(args, args1):
+            msg = self._fixed_message(test, call,
+                  " modified argument(s): " + self._str_tuple(args1))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
@@ -593,19 +1391,34 @@ class FunctionTestOnMutableArgs (FunctionTestWithExplanation):
     ## end class FunctionTestOnMutableArgs
 
 class FunctionTestArgModifier (FunctionTestWithExplanation):
+    '''Tests a function that modifies its (first) argument in place:
+    the modified argument is checked as the answer. The function is
+    called on a copy of the arguments (see cheap_copy()). With
+    check_other_args set, modifying any other argument also fails the
+    test (see FunctionTestOnMutableArgs).'''
 
-    import copy
+    check_other_args = False
 
     def _run_test(self, test):
-        args = self._get_test_args(test)
-        args1 = self.copy.deepcopy(args)
+        args = resolve_args(self._get_test_args(test))
+        call = self._call_string(test)
+        args1 = cheap_copy(tuple(args))
         if self.verbose > 1:
             print("calling " + self.name + self._str_tuple(args))
         try:
             self.function(*args1)
         except Exception as exc:
-            msg = self._call_string(test) + \
-                  " caused " + exc.__class__.__name__ + " " + str(exc)
+            msg = self._fixed_message(test, call,
+                  " caused " + exc.__class__.__name__ + " " + str(exc))
+            if self.raise_exceptions:
+                raise Exception(msg)
+            else:
+                return False, msg
+        if self.check_other_args and \
+           FunctionTestOnMutableArgs._modified(tuple(args[1:]), args1[1:]):
+            msg = self._fixed_message(test, call,
+                  " modified argument(s) other than the first: " + \
+                  self._str_tuple(args1[1:]))
             if self.raise_exceptions:
                 raise Exception(msg)
             else:
@@ -615,36 +1428,338 @@ class FunctionTestArgModifier (FunctionTestWithExplanation):
 
     ## end class FunctionTestArgModifier
 
+class FunctionTestComplexity (FunctionTestBase):
+    '''Tests how the run time of the function grows with the size of
+    its input, compared to a reference solution. make_input(n) must
+    return an argument tuple for an input of size n. Both functions
+    are timed (best of repeat calls) on inputs of sizes min_size,
+    2*min_size, ... (up to max_size), for as long as each stays within
+    half of time_budget; the growth exponent k (time ~ n**k) is fitted
+    by least squares to the times of at least min_time seconds. The
+    test passes if the function's exponent is at most tolerance above
+    the reference's (or if either is too fast to measure). This is a
+    single test case: details has one entry, for the whole measurement.'''
+
+    def __init__(self, function, reference, make_input,
+                 min_size = 128, max_size = 2 ** 20, tolerance = 0.5,
+                 time_budget = 2.0, repeat = 3, min_time = 1e-4,
+                 verbose = 0, raise_exceptions = True,
+                 suppress_output = False):
+        FunctionTestBase.__init__(self, function, ((min_size, max_size),),
+                                  True, verbose, raise_exceptions,
+                                  suppress_output)
+        self.reference = reference
+        self.make_input = make_input
+        self.tolerance = tolerance
+        self.time_budget = time_budget
+        self.repeat = repeat
+        self.min_time = min_time
+        # the watchdog stops a function that is far too slow
+        self.case_timeout = 2 * time_budget
+
+    def _call_string(self, test):
+        return "call " + self.name + " on inputs of size " + str(test[0]) + \
+            " to " + str(test[1])
+
+    def _measure(self, function, test):
+        min_size, max_size = test
+        budget = self.time_budget / 2
+        spent = 0
+        points = []
+        size = min_size
+        while size <= max_size:
+            args = self.make_input(size)
+            best = None
+            for r in range(self.repeat):
+                start = time.perf_counter()
+                function(*args)
+                elapsed = time.perf_counter() - start
+                spent += elapsed
+                if best is None or elapsed < best:
+                    best = elapsed
+            if best >= self.min_time:
+                points.append((size, best))
+            # stop unless the next size (at up to 4 times the time)
+            # fits in the remaining budget
+            if spent + 4 * best * self.repeat > budget:
+                break
+            size *= 2
+        return points
+
+    def _fit_exponent(self, points):
+        if len(points) < 3:
+            return None
+        import math
+        xs = [math.log(size) for (size, t) in points]
+        ys = [math.log(t) for (size, t) in points]
+        x_mean = sum(xs) / len(xs)
+        y_mean = sum(ys) / len(ys)
+        sxx = sum([(x - x_mean) ** 2 for x in xs])
+        sxy = sum([(x - x_mean) * (y - y_mean) for (x, y) in zip(xs, ys)])
+        return sxy / sxx
+
+    def _run_test(self, test):
+        if self.verbose > 1:
+            print(self._call_string(test))
+        try:
+            exponent = self._fit_exponent(self._measure(self.function, test))
+        except Exception as exc:
+            msg = self._message(test,
+                  " caused " + exc.__class__.__name__ + " " + str(exc))
+            if self.raise_exceptions:
+                raise Exception(msg)
+            else:
+                return False, msg
+        ref_exponent = self._fit_exponent(self._measure(self.reference, test))
+        if exponent is None or ref_exponent is None:
+            return True, self._message(test, " ok (too fast to measure)")
+        growth = "run time grows as n^" + "{:.2f}".format(exponent) + \
+                 "; the reference solution's grows as n^" + \
+                 "{:.2f}".format(ref_exponent)
+        if exponent > ref_exponent + self.tolerance:
+            msg = self._message(test, " is too slow: " + growth)
+            if self.raise_exceptions:
+                raise Exception(msg)
+            else:
+                return False, msg
+        return True, self._message(test, " ok (" + growth + ")")
+
+    ## end class FunctionTestComplexity
+
+class FunctionTestGenerated (FunctionTestBase):
+    '''Test cases described by generator specs instead of literal
+    (args, answer) tuples. Each test is a dict (e.g., size, seed and
+    distribution parameters); make_test(spec) must return the pair
+    (args, expected answer) for it, deterministically, so that the same
+    spec always gives the same test. Tests are generated only when run,
+    in the stage process, and messages describe the spec rather than
+    the (possibly very large) arguments.'''
+
+    def __init__(self, function, tests = tuple(), make_test = None,
+                 type_cast_answer = True,
+                 verbose = 0, raise_exceptions = True,
+                 suppress_output = False):
+        FunctionTestBase.__init__(self, function, tests, type_cast_answer,
+                                  verbose, raise_exceptions, suppress_output)
+        self.make_test = make_test
+
+    def _spec(self, test):
+        # test is either a spec, or a generated (args, answer, spec)
+        if isinstance(test, dict):
+            return test
+        return test[2]
+
+    def _call_string(self, test):
+        spec = self._spec(test)
+        return "call " + self.name + " on generated input (" + \
+            ", ".join([key + "=" + repr(value) for (key, value) in spec.items()]) + ")"
+
+    def _run_test(self, test):
+        args, answer = self.make_test(test)
+        return FunctionTestBase._run_test(self, (args, answer, test))
+
+    ## end class FunctionTestGenerated
+
+class FunctionTestDifferential (FunctionTestBase):
+    '''Randomised differential test against a reference solution.
+    make_batch(seed, size) must return a list of size argument tuples
+    (deterministically for the seed); the answers of the function and
+    of reference(*args) are compared for every one, or, if
+    batch_reference is given, to batch_reference(batch), which returns
+    the reference answers for a whole batch (e.g., vectorised). Batches
+    (from batch_size / 64 up to batch_size inputs, doubling) are run
+    for time_budget seconds, or until max_cases inputs. The first input
+    with a different answer (or an exception) is shrunk to a minimal
+    one: shrink(args) gives smaller candidate argument tuples, and the
+    first that still fails is taken, until none does (for at most
+    time_budget seconds more); the default, shrink_args, shortens lists
+    and moves ints toward 0. If a batch fails but none of its inputs
+    does when called again alone, the batch run is reported instead.
+    The function is always called on copies of the arguments. The test
+    passes if no input fails. This is a single test case: details has
+    one entry, for the whole run.'''
+
+    def __init__(self, function, reference, make_batch, shrink = None,
+                 batch_reference = None, time_budget = 1.0, batch_size = 8192,
+                 seed = 0, max_cases = None,
+                 verbose = 0, raise_exceptions = True,
+                 suppress_output = False):
+        FunctionTestBase.__init__(self, function, ((time_budget, seed),),
+                                  True, verbose, raise_exceptions,
+                                  suppress_output)
+        self.reference = reference
+        self.make_batch = make_batch
+        self.shrink = shrink
+        if shrink is None:
+            self.shrink = FunctionTestDifferential.shrink_args
+        self.batch_reference = batch_reference
+        self.batch_size = batch_size
+        self.max_cases = max_cases
+        # the watchdog stops a function that hangs on some input
+        self.case_timeout = 4 * time_budget
+
+    def _call_string(self, test):
+        return "call " + self.name + " on random inputs (" + str(test[0]) + \
+            " s, seed " + str(test[1]) + ")"
+
+    @staticmethod
+    def shrink_args(args):
+        # candidates, each with one argument made smaller
+        for i in range(len(args)):
+            for smaller in FunctionTestDifferential.shrink_value(args[i]):
+                yield tuple(args[:i]) + (smaller,) + tuple(args[i + 1:])
+
+    @staticmethod
+    def shrink_value(value):
+        if isinstance(value, list):
+            n = len(value)
+            if n > 1:
+                yield value[:n // 2]
+                yield value[n // 2:]
+            for j in range(n):
+                yield value[:j] + value[j + 1:]
+            for j in range(n):
+                for smaller in FunctionTestDifferential.shrink_value(value[j]):
+                    yield value[:j] + [smaller] + value[j + 1:]
+        elif isinstance(value, int) and not isinstance(value, bool) and value != 0:
+            yield 0
+            if abs(value) > 1:
+                yield int(value / 2)
+            if value < 0:
+                yield -value
+
+    def _failure(self, args, expected = None):
+        # None if the function agrees with the reference on args,
+        # else the message for it
+        if expected is None:
+            expected = self.reference(*args)
+        call = "call " + self.name + self._str_tuple(args)
+        try:
+            # (on a copy: args may be shrunk further, or given again)
+            fvalue = self.function(*cheap_copy(args))
+        except Exception as exc:
+            return call + " caused " + exc.__class__.__name__ + " " + str(exc)
+        if fvalue != expected:
+            return call + " returned incorrect answer " + str(fvalue) + \
+                "; the expected answer is " + str(expected)
+        return None
+
+    def _run_test(self, test):
+        time_budget, seed = test
+        if self.verbose > 1:
+            print(self._call_string(test))
+        deadline = time.perf_counter() + time_budget
+        n_cases = 0
+        size = max(1, self.batch_size // 64)
+        k = 0
+        while time.perf_counter() < deadline:
+            if self.max_cases is not None:
+                if n_cases >= self.max_cases:
+                    break
+                size = min(size, self.max_cases - n_cases)
+            batch = self.make_batch(seed + k, size)
+            k += 1
+            if self.batch_reference is not None:
+                expected = list(self.batch_reference(batch))
+            else:
+                expected = [self.reference(*args) for args in batch]
+            function = self.function
+            batch_exc = None
+            try:
+                copies = cheap_copy([tuple(args) for args in batch])
+                got = [function(*args) for args in copies]
+            except Exception as exc:
+                got = None
+                batch_exc = exc
+            if got != expected:
+                # find the first failing input (again, one at a time)
+                for (i, (args, answer)) in enumerate(zip(batch, expected)):
+                    if self._failure(args, answer) is not None:
+                        return self._shrunk_failure(test, args, n_cases + i + 1)
+                return self._batch_failure(test, batch, got, expected, batch_exc,
+                                           n_cases)
+            n_cases += len(batch)
+            size = min(2 * size, self.batch_size)
+        return True, self._message(test, " ok (" + str(n_cases) + " random inputs)")
+
+    def _batch_failure(self, test, batch, got, expected, batch_exc, n_cases):
+        # the batch run failed, but no input fails when run alone (the
+        # function depends on earlier calls): report the batch run
+        if got is None:
+            failure = "caused " + batch_exc.__class__.__name__ + " " + str(batch_exc) + \
+                " on a batch of " + str(len(batch)) + " random inputs"
+        else:
+            i = [g == e for (g, e) in zip(got, expected)].index(False)
+            failure = "call " + self.name + self._str_tuple(batch[i]) + \
+                " returned incorrect answer " + str(got[i]) + \
+                "; the expected answer is " + str(expected[i]) + \
+                " (random input " + str(n_cases + i + 1) + ", after " + \
+                str(i) + " others in the same batch)"
+        msg = self._message(test, " failed on random inputs, but not when each was" + \
+                            " called again alone: " + failure)
+        if self.raise_exceptions:
+            raise Exception(msg)
+        else:
+            return False, msg
+
+    def _shrunk_failure(self, test, args, n_cases):
+        deadline = time.perf_counter() + test[0]
+        failure = self._failure(args)
+        improved = True
+        while improved and time.perf_counter() < deadline:
+            improved = False
+            for candidate in self.shrink(args):
+                candidate_failure = self._failure(candidate)
+                if candidate_failure is not None:
+                    args, failure = candidate, candidate_failure
+                    improved = True
+                    break
+        msg = self._message(test, " found a failing input after " + str(n_cases) +
+                            " random inputs: " + failure)
+        if self.raise_exceptions:
+            raise Exception(msg)
+        else:
+            return False, msg
+
+    ## end class FunctionTestDifferential
+
 class StagedTest:
 
     def __init__(self, tests = tuple(), verbose = 0,
-                 raise_exceptions = True, timeout = None):
+                 raise_exceptions = True, timeout = None, parallel = 1):
         self.raise_exceptions = raise_exceptions
         self.verbose = verbose
         self.tests = tests
         self.details = None
         self.collate = 0
         self.timeout = timeout
+        self.timeouts = None
+        self.stage_times = None
+        # number of stages (each in its own process, with its own
+        # time-out) that may run at the same time; stages are
+        # independent, and results are the same for any number
+        self.parallel = parallel
+        # the ModuleTestBase the tested functions come from; if set,
+        # its pre_test_run sandbox is applied in each stage process
+        self.module_test = None
 
     def run(self):
         n_passed = 0
         self.details = []
-        for (i, test) in enumerate(self.tests):
-            if self.verbose > 1:
-                print("testing stage " + str(i + 1))
-                
-            #passed, msg = test.run()
-            manager = multiprocessing.Manager()
-            run_result = manager.list()
-            proc = multiprocessing.Process(target = test.run, args = (run_result,))
-            proc.start()
-            proc.join(timeout = self.timeout)
-            proc.terminate()
+        self.timeouts = []
+        self.stage_times = []
+        for (i, test, run_result, details, usage, stage_time) in self._run_stages():
+            if usage is None or all([case_usage is None for case_usage in usage]):
+                usage = None
+            self.stage_times.append(stage_time)
             if len(run_result) == 0:
                 # timeout
                 passed = False
                 msg = "timeout"
+                self.timeouts.append(i + 1)
+                test.set_partial_details(details, usage)
             else:
+                test.set_details(details, usage)
                 passed = run_result[0]
                 msg = run_result[1]
             
@@ -668,12 +1783,116 @@ class StagedTest:
                 return False, "stages " + " & ".join([str(snum) for snum in self.solved()]) + \
                     " of " + str(len(self.tests)) + " passed"
 
+    def _stage_target(self, test, conn):
+        test.report = lambda detail, usage: conn.send(('case', detail, usage))
+        if self.module_test is not None:
+            # (open is disabled by the sandbox)
+            for vector in table_vectors((test.tests,)):
+                vector.prepare()
+            self.module_test.pre_test_run()
+        run_result = []
+        test.run(run_result)
+        conn.send(('stage', run_result, test.details, test.usage))
+        conn.close()
+
+    def _get_timeout(self, index):
+        # timeout can be one limit for every stage, or one per stage
+        if isinstance(self.timeout, (list, tuple)):
+            return self.timeout[index]
+        return self.timeout
+
+    def _run_stages(self):
+        # run each stage in a child process, up to self.parallel at a
+        # time; each test case result is sent back over a one-way pipe
+        # as it finishes, followed by the (passed, msg) stage result and
+        # the full details. If a stage does not finish within its
+        # timeout (or dies), its run result is an empty list and its
+        # details are those received so far. Yields (index, test,
+        # run_result, details, usage, time) for each stage, in stage
+        # order (usage is a list of None if not instrumented).
+        parallel = max(1, self.parallel or 1)
+        stages = [None] * len(self.tests)
+        running = []
+        next_start = 0
+        next_yield = 0
+        while next_yield < len(self.tests):
+            while next_start < len(self.tests) and len(running) < parallel:
+                stages[next_start] = self._start_stage(next_start)
+                running.append(stages[next_start])
+                next_start += 1
+            wait_time = None
+            deadlines = [stage['deadline'] for stage in running
+                         if stage['deadline'] is not None]
+            if len(deadlines) > 0:
+                wait_time = max(0, min(deadlines) - time.monotonic())
+            ready = multiprocessing.connection.wait(
+                [stage['conn'] for stage in running], wait_time)
+            for stage in list(running):
+                if stage['conn'] in ready:
+                    self._read_stage(stage)
+                elif stage['deadline'] is not None and \
+                     time.monotonic() >= stage['deadline']:
+                    stage['done'] = True
+                if stage['done']:
+                    self._stop_stage(stage)
+                    running.remove(stage)
+            while next_yield < len(self.tests) and stages[next_yield] is not None \
+                  and stages[next_yield]['done']:
+                stage = stages[next_yield]
+                yield (next_yield, self.tests[next_yield], stage['run_result'],
+                       stage['details'], stage['usage'], stage['time'])
+                stages[next_yield] = None
+                next_yield += 1
+
+    def _start_stage(self, index):
+        if self.verbose > 1:
+            print("testing stage " + str(index + 1))
+        test = self.tests[index]
+        recv_conn, send_conn = multiprocessing.Pipe(duplex = False)
+        proc = multiprocessing.Process(target = self._stage_target,
+                                       args = (test, send_conn))
+        start = time.monotonic()
+        proc.start()
+        send_conn.close()
+        timeout = self._get_timeout(index)
+        deadline = None
+        if timeout is not None:
+            deadline = start + timeout
+        return dict(proc = proc, conn = recv_conn, start = start,
+                    deadline = deadline, run_result = [], details = [],
+                    usage = [], time = None, done = False)
+
+    def _read_stage(self, stage):
+        # read the messages waiting from a stage process
+        conn = stage['conn']
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == 'case':
+                    stage['details'].append(message[1])
+                    stage['usage'].append(message[2])
+                else:
+                    stage['run_result'], stage['details'], stage['usage'] = \
+                        message[1], message[2], message[3]
+                    stage['done'] = True
+                    return
+        except (EOFError, OSError):
+            stage['done'] = True
+
+    def _stop_stage(self, stage):
+        stage['time'] = time.monotonic() - stage['start']
+        stage['conn'].close()
+        proc = stage['proc']
+        proc.join(timeout = 0.1)
+        proc.terminate()
+        proc.join()
+
     def solved(self):
         ## this can only be called after tests have been run
         assert self.details is not None
         return [snum for snum, spass, _ in self.details if spass]
 
-    def total(self):
+    def total(self, resources = False):
         ## can only be called after tests have run:
         assert self.details is not None
         passed = 0
@@ -682,12 +1901,36 @@ class StagedTest:
             stage_passed, stage_failed = test.total()
             passed += stage_passed
             failed += stage_failed
-        return passed, failed
+        if not resources:
+            return passed, failed
+        return passed, failed, \
+            sum_usage([test.total(True)[2] for test in self.tests])
 
-    def totals_by_stage(self):
+    def totals_by_stage(self, resources = False):
         ## can only be called after tests have run:
         assert self.details is not None
-        return [test.total() for test in self.tests]
+        return [test.total(resources) for test in self.tests]
+
+    def stage_records(self):
+        '''Per-stage results (with per test case results) as a list of
+        dicts, e.g. for JSONResultWriter. Only after tests have run.'''
+        assert self.details is not None
+        records = []
+        for ((snum, spass, smsg), test, stime) in \
+            zip(self.details, self.tests, self.stage_times):
+            cases = []
+            if test.details is not None:
+                cases = [dict(case = num, passed = passed, msg = str(msg))
+                         for (num, passed, msg) in test.details]
+            record = dict(stage = snum, passed = spass, msg = smsg,
+                          time = stime, cases = cases)
+            if test.usage is not None:
+                for (case, case_usage) in zip(cases, test.usage):
+                    if case_usage is not None:
+                        case.update(case_usage)
+                record['usage'] = test.total(True)[2]
+            records.append(record)
+        return records
 
     def failed_stage_messages(self):
         ## this can only be called after tests have been run
@@ -706,3 +1949,683 @@ class StagedTest:
         return None
         
     ## end class StagedTest
+
+
+class ResultCache:
+    '''On-disk cache of (mark, msg, record) results, one small JSON file per
+    key. Entries are written to a temporary file and renamed into
+    place, so processes sharing the directory never see a partial
+    entry. A hit updates the entry's modification time, and put()
+    evicts least recently used entries once there are more than
+    max_entries, or they take more than max_bytes. The directory is
+    only scanned when a running count of entries and bytes (from the
+    last scan plus this object's puts since) passes a limit, and
+    eviction then goes down to low_water times the limits, so that
+    scans are rare; entries put by other processes are only counted at
+    the next scan, so a shared directory can overshoot a little.'''
+
+    low_water = 0.9
+
+    def __init__(self, directory, max_entries = 10000, max_bytes = None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # estimated contents of the directory; None until the first scan
+        self.n_entries = None
+        self.n_bytes = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            os.utime(path)
+            return entry['mark'], entry['msg'], entry.get('record')
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, key, mark, msg, record = None):
+        fd, tmp_path = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'mark': mark, 'msg': msg, 'record': record}, f)
+                size = f.tell()
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        if self.n_entries is not None:
+            # (a replaced entry is counted twice until the next scan)
+            self.n_entries += 1
+            self.n_bytes += size
+            if self.n_entries <= self.max_entries and \
+               (self.max_bytes is None or self.n_bytes <= self.max_bytes):
+                return
+        self.evict()
+
+    def evict(self):
+        # scans the directory; if over a limit, removes least recently
+        # used entries until under low_water times the limits
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total_bytes += st.st_size
+        n_entries = len(entries)
+        if n_entries <= self.max_entries and \
+           (self.max_bytes is None or total_bytes <= self.max_bytes):
+            self.n_entries, self.n_bytes = n_entries, total_bytes
+            return
+        max_entries = int(self.max_entries * self.low_water)
+        max_bytes = None
+        if self.max_bytes is not None:
+            max_bytes = int(self.max_bytes * self.low_water)
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if n_entries <= max_entries and \
+               (max_bytes is None or total_bytes <= max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process got there first
+                pass
+            n_entries -= 1
+            total_bytes -= size
+        self.n_entries, self.n_bytes = n_entries, total_bytes
+
+    ## end class ResultCache
+
+class TimeoutCalibration:
+    '''Time limits derived from the run time of a reference solution
+    on this machine. function is the reference implementation and
+    stage_tests a sequence of test tables (one per stage, in the
+    format used by FunctionTestBase). Each case limit is factor times
+    the measured time of the case, but at least min_case_timeout; each
+    stage limit is min_stage_timeout plus factor times the stage's
+    total measured time. Measurements are saved in a JSON file, per
+    host name and per test tables, so are made only once per host.'''
+
+    def __init__(self, function, stage_tests, factor = 20,
+                 min_case_timeout = 0.5, min_stage_timeout = 2, repeat = 5):
+        self.function = function
+        self.stage_tests = stage_tests
+        self.factor = factor
+        self.min_case_timeout = min_case_timeout
+        self.min_stage_timeout = min_stage_timeout
+        self.repeat = repeat
+        self.case_times = None
+        self.case_timeouts = None
+        self.stage_timeouts = None
+
+    def fingerprint(self):
+        h = hashlib.sha256()
+        h.update(self.function.__module__.encode('utf-8'))
+        h.update(self.function.__qualname__.encode('utf-8'))
+        h.update(repr(self.stage_tests).encode('utf-8'))
+        h.update(repr(vector_stamps(self.stage_tests)).encode('utf-8'))
+        return h.hexdigest()
+
+    def _time_case(self, test):
+        # best of repeat runs
+        args = resolve_args(test[0])
+        best = None
+        for r in range(self.repeat):
+            start = time.perf_counter()
+            self.function(*args)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def measure(self):
+        self.case_times = [[self._time_case(test) for test in tests]
+                           for tests in self.stage_tests]
+        self._set_timeouts()
+
+    def _set_timeouts(self):
+        self.case_timeouts = [[max(self.min_case_timeout, self.factor * t)
+                               for t in times] for times in self.case_times]
+        self.stage_timeouts = [self.min_stage_timeout + self.factor * sum(times)
+                               for times in self.case_times]
+
+    def load_or_measure(self, path):
+        '''Use the measurements saved in path for this host, if there
+        are any (for the same reference function and test tables);
+        otherwise, measure and save them.'''
+        import socket
+        host = socket.gethostname()
+        key = self.fingerprint()
+        saved = dict()
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if key in saved.get(host, dict()):
+            self.case_times = saved[host][key]
+            self._set_timeouts()
+            return
+        self.measure()
+        saved.setdefault(host, dict())[key] = self.case_times
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, path)
+
+    ## end class TimeoutCalibration
+
+class JSONResultWriter:
+    '''Writes one JSON record per line (JSONL) for each marked file,
+    flushing after each, so that the file can be followed while a
+    batch runs. If the file exists, records are appended to it, and
+    done() gives the records already there, so that an interrupted
+    batch can be resumed.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    @staticmethod
+    def read(path):
+        '''Generator yielding the records in a JSONL result file; a
+        partly written last line (from an interrupted run) is skipped.'''
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                yield record
+
+    def done(self):
+        '''The records already in the file, by file path.'''
+        if not os.path.exists(self.path):
+            return dict()
+        return dict([(record['file'], record) for record in self.read(self.path)
+                     if 'file' in record])
+
+    def write(self, path, mark, msg, record = None):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+            # start on a new line if the last run stopped mid-record
+            if self.file.tell() > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.file.write('\n')
+        full_record = dict(file = path, mark = mark, msg = msg)
+        if record is not None:
+            full_record.update([(key, value) for (key, value) in record.items()
+                                if key not in full_record])
+        self.file.write(json.dumps(full_record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    ## end class JSONResultWriter
+
+class BatchTest:
+    '''Marks many submission files with a pool of worker processes.
+    mark_file is called in a forked worker with a file path and must
+    return a (mark, msg) pair, or a (mark, msg, record) triple, where
+    record is a dict of further (JSON-serialisable) details; a worker
+    that raises or does not finish within file_timeout seconds gets
+    mark 0 and an explanatory message. Results are yielded in input
+    order.
+
+    Modules named in preload are imported once, in this process,
+    before any worker is started; forked workers (and the stage
+    processes they fork in turn) then find them already in
+    sys.modules. Only the import is done here: any sandboxing, such as
+    ModuleTestBase.pre_test_run, is left to the child.
+
+    If lookup is given, it is called (in this process) with each path
+    before a worker is started for it; if it returns a result (as
+    mark_file would), that is used and no worker is started.
+
+    If group_key is given, it is called (in this process) with each
+    path that lookup did not resolve; files with the same key (other
+    than None) are marked only once, and the result of the first is
+    given to the others, with its file name replaced by theirs.'''
+
+    def __init__(self, mark_file, paths = tuple(), jobs = None,
+                 file_timeout = None, verbose = 0, preload = tuple(),
+                 lookup = None, group_key = None):
+        self.mark_file = mark_file
+        self.preload = preload
+        self.lookup = lookup
+        self.group_key = group_key
+        self.paths = list(paths)
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = max(1, jobs)
+        self.file_timeout = file_timeout
+        self.verbose = verbose
+
+    @staticmethod
+    def find_files(pattern):
+        '''Expand a directory (all .py files in it) or a glob pattern
+        to a sorted list of file paths.'''
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.py')
+        return sorted([path for path in glob.glob(pattern)
+                       if os.path.isfile(path)])
+
+    def preload_modules(self):
+        for name in self.preload:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                # the submission will get the import error when loaded
+                if self.verbose > 0:
+                    print("could not preload module " + name)
+
+    def _as_triple(self, result):
+        if len(result) == 2:
+            return result[0], result[1], None
+        return tuple(result)
+
+    def _worker(self, path, conn):
+        # a process group of its own, so that _stop also stops the
+        # stage processes it starts
+        os.setpgid(0, 0)
+        try:
+            result = self._as_triple(self.mark_file(path))
+        except BaseException as exc:
+            result = (0, exc.__class__.__name__ + " " + str(exc) +
+                      " marking " + path, None)
+        conn.send(result)
+        conn.close()
+
+    def _start(self, index):
+        parent_conn, child_conn = multiprocessing.Pipe(duplex = False)
+        proc = multiprocessing.Process(target = self._worker,
+                                       args = (self.paths[index], child_conn))
+        proc.start()
+        child_conn.close()
+        return proc, parent_conn, time.monotonic()
+
+    @staticmethod
+    def _receive(conn):
+        # the worker's result, or None if it sent none; closes conn
+        result = None
+        try:
+            if conn.poll():
+                result = conn.recv()
+        except (EOFError, OSError):
+            pass
+        conn.close()
+        return result
+
+    def _finish(self, proc, conn, path):
+        result = self._receive(conn)
+        proc.join(timeout = 1)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+        if result is None:
+            result = (0, "marking " + path + " crashed (exit code " +
+                      str(proc.exitcode) + ")", None)
+        return result
+
+    @staticmethod
+    def _kill(proc):
+        # signal a worker that ran out of time, and its stage processes
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            proc.terminate()
+
+    def _stop(self, proc):
+        self._kill(proc)
+        proc.join()
+
+    def _fan_out(self, result, from_path, to_path):
+        mark, msg, record = result
+        msg = msg.replace(from_path, to_path)
+        msg = msg.replace(os.path.basename(from_path), os.path.basename(to_path))
+        if record is not None:
+            record = dict(record)
+            record['same_as'] = from_path
+        return mark, msg, record
+
+    def _record(self, results, followers, index, result):
+        results[index] = result
+        if index in followers:
+            # keep the result for files of this group not started yet
+            self.group_results[index] = result
+        for other in followers.pop(index, []):
+            results[other] = self._fan_out(result, self.paths[index],
+                                           self.paths[other])
+
+    def run(self):
+        '''Generator yielding (path, mark, msg, record) for each file,
+        in the order of self.paths; record may be None.'''
+        self.preload_modules()
+        results = dict()
+        running = dict()
+        # group key -> index of the file marked for the group;
+        # index of that file -> indices of files waiting for its result
+        # (until it is marked), and -> its result (once marked)
+        groups = dict()
+        followers = dict()
+        self.group_results = dict()
+        next_start = 0
+        next_yield = 0
+        while next_yield < len(self.paths):
+            while next_start < len(self.paths) and len(running) < self.jobs:
+                index = next_start
+                next_start += 1
+                result = None
+                if self.lookup is not None:
+                    result = self.lookup(self.paths[index])
+                if result is not None:
+                    results[index] = self._as_triple(result)
+                    continue
+                key = None
+                if self.group_key is not None:
+                    key = self.group_key(self.paths[index])
+                if key is not None and key in groups:
+                    first = groups[key]
+                    if first in self.group_results:
+                        results[index] = self._fan_out(self.group_results[first],
+                                                       self.paths[first],
+                                                       self.paths[index])
+                    else:
+                        followers[first].append(index)
+                    continue
+                if key is not None:
+                    groups[key] = index
+                    followers[index] = []
+                running[index] = self._start(index)
+            while next_yield in results:
+                mark, msg, record = results.pop(next_yield)
+                yield self.paths[next_yield], mark, msg, record
+                next_yield += 1
+            if len(running) == 0:
+                continue
+            wait_time = None
+            if self.file_timeout is not None:
+                now = time.monotonic()
+                wait_time = max(0, min([started + self.file_timeout - now
+                                        for (_, _, started) in running.values()]))
+            ready = multiprocessing.connection.wait(
+                [conn for (_, conn, _) in running.values()], timeout = wait_time)
+            now = time.monotonic()
+            for index in list(running.keys()):
+                proc, conn, started = running[index]
+                path = self.paths[index]
+                if conn in ready:
+                    self._record(results, followers, index,
+                                 self._finish(proc, conn, path))
+                elif self.file_timeout is not None and \
+                     now - started >= self.file_timeout:
+                    self._stop(proc)
+                    conn.close()
+                    self._record(results, followers, index,
+                                 (0, "timeout marking " + path, None))
+                else:
+                    continue
+                del running[index]
+                if self.verbose > 1:
+                    print("marked " + path)
+
+    ## end class BatchTest
+
+
+class MarkingServer:
+    '''A long-running marking service: submissions are posted over HTTP
+    (on a localhost port, or a Unix socket), queued, and marked by up to
+    jobs workers, each forked from this (warm) process, as in BatchTest
+    (mark_file, file_timeout and preload are as for BatchTest). The
+    queue holds at most queue_size submissions; when it is full, a new
+    submission is refused with 503, so clients can back off and retry.
+
+        POST /mark?name=q5.py    body: the submission source; replies
+                                 mark|msg, or with &format=json a JSON
+                                 object with file, mark, msg and record
+        GET /health              200 ok, or 503 draining
+        GET /queue               JSON: queued, running, capacity, ...
+
+    On SIGTERM or SIGINT the server drains: new submissions are refused
+    (503), the ones already queued are marked and answered, and then it
+    stops.'''
+
+    max_size = 1 << 20
+
+    def __init__(self, mark_file, jobs = None, queue_size = 100,
+                 file_timeout = None, verbose = 0, preload = tuple()):
+        self.batch = BatchTest(mark_file, tuple(), jobs, file_timeout,
+                               verbose, preload)
+        self.jobs = self.batch.jobs
+        self.queue_size = queue_size
+        self.file_timeout = file_timeout
+        self.verbose = verbose
+        self.queue = None
+        self.running = 0
+        self.marked = 0
+        self.draining = False
+
+    def serve(self, port = None, host = '127.0.0.1', path = None):
+        '''Serve on host:port, or on the Unix socket path, until drained.'''
+        import asyncio
+        asyncio.run(self._serve(port, host, path))
+
+    async def _serve(self, port, host, path):
+        import asyncio
+        self.batch.preload_modules()
+        self.spool = tempfile.mkdtemp(prefix = "marking_")
+        self.queue = asyncio.Queue(self.queue_size)
+        self.stopped = asyncio.Event()
+        self.handlers = set()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.drain)
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle, path = path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        workers = [asyncio.create_task(self._work()) for k in range(self.jobs)]
+        if self.verbose > 0:
+            print("serving on " + str(path if path is not None else (host, port)),
+                  flush = True)
+        try:
+            await self.stopped.wait()
+            # (health and queue requests are still answered meanwhile)
+            await self.queue.join()
+            # let the replies for the last submissions be sent
+            if len(self.handlers) > 0:
+                await asyncio.wait(list(self.handlers), timeout = 10)
+        finally:
+            server.close()
+            for worker in workers:
+                worker.cancel()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+            shutil.rmtree(self.spool, ignore_errors = True)
+        if self.verbose > 0:
+            print("drained, " + str(self.marked) + " submissions marked", flush = True)
+
+    def drain(self):
+        '''Stop taking submissions; stop once the queued ones are marked.'''
+        self.draining = True
+        self.stopped.set()
+
+    def _worker(self, path, conn):
+        # (the forked worker must not keep this process's signal handling)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self.batch._worker(path, conn)
+
+    async def _work(self):
+        while True:
+            path, future = await self.queue.get()
+            self.running += 1
+            try:
+                result = await self._mark(path)
+            except Exception as exc:
+                result = (0, exc.__class__.__name__ + " " + str(exc) +
+                          " marking " + path, None)
+            self.running -= 1
+            self.marked += 1
+            if not future.done():
+                future.set_result(result)
+            self.queue.task_done()
+
+    async def _mark(self, path):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        parent_conn, child_conn = multiprocessing.Pipe(duplex = False)
+        proc = multiprocessing.Process(target = self._worker,
+                                       args = (path, child_conn))
+        proc.start()
+        child_conn.close()
+        ready = loop.create_future()
+        def on_ready():
+            if not ready.done():
+                ready.set_result(None)
+        loop.add_reader(parent_conn.fileno(), on_ready)
+        try:
+            await asyncio.wait_for(ready, self.file_timeout)
+        except asyncio.TimeoutError:
+            self.batch._kill(proc)
+            await self._reap(proc)
+            return (0, "timeout marking " + path, None)
+        finally:
+            loop.remove_reader(parent_conn.fileno())
+            if not ready.done() or ready.cancelled():
+                parent_conn.close()
+        # as BatchTest._finish, without blocking the event loop
+        result = self.batch._receive(parent_conn)
+        if not await self._reap(proc, 1):
+            proc.terminate()
+            await self._reap(proc)
+        if result is None:
+            result = (0, "marking " + path + " crashed (exit code " +
+                      str(proc.exitcode) + ")", None)
+        return result
+
+    async def _reap(self, proc, timeout = None):
+        # wait for a worker to exit by polling, rather than in executor
+        # threads: workers are forked from this process, and a fork
+        # while other threads run can deadlock the child; returns
+        # whether it exited within timeout
+        import asyncio
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while proc.is_alive():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.01)
+        proc.join()
+        return True
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            await self._handle_request(reader, writer)
+        finally:
+            self.handlers.discard(task)
+
+    async def _handle_request(self, reader, writer):
+        import asyncio
+        import urllib.parse
+        try:
+            request_line = await reader.readline()
+            method, target = request_line.decode('latin-1').split()[:2]
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, sep, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length > self.max_size:
+                status, content_type, content = 413, 'text/plain', "submission too large\n"
+            else:
+                body = await reader.readexactly(length)
+                url = urllib.parse.urlsplit(target)
+                query = urllib.parse.parse_qs(url.query)
+                status, content_type, content = \
+                    await self._respond(method, url.path, query, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, content_type, content = 400, 'text/plain', "bad request\n"
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found",
+                   413: "Payload Too Large", 503: "Service Unavailable"}
+        content = content.encode('utf-8')
+        head = "HTTP/1.1 " + str(status) + " " + reasons[status] + "\r\n" + \
+               "Content-Type: " + content_type + "; charset=utf-8\r\n" + \
+               "Content-Length: " + str(len(content)) + "\r\n" + \
+               "Connection: close\r\n\r\n"
+        try:
+            writer.write(head.encode('latin-1') + content)
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+
+    async def _respond(self, method, path, query, body):
+        # returns (status, content type, content)
+        import asyncio
+        if path == '/health':
+            if self.draining:
+                return 503, 'text/plain', "draining\n"
+            return 200, 'text/plain', "ok\n"
+        if path == '/queue':
+            state = dict(queued = self.queue.qsize(), running = self.running,
+                         capacity = self.queue_size, workers = self.jobs,
+                         marked = self.marked, draining = self.draining)
+            return 200, 'application/json', json.dumps(state) + "\n"
+        if path != '/mark' or method != 'POST':
+            return 404, 'text/plain', "not found\n"
+        if self.draining:
+            return 503, 'text/plain', "draining\n"
+        name = os.path.basename(query.get('name', ["submission.py"])[0])
+        if name in ('', '.', '..'):
+            name = "submission.py"
+        if self.queue.full():
+            return 503, 'text/plain', "queue full\n"
+        directory = tempfile.mkdtemp(dir = self.spool)
+        filepath = os.path.join(directory, name)
+        try:
+            with open(filepath, 'wb') as f:
+                f.write(body)
+            future = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait((filepath, future))
+            mark, msg, record = await asyncio.shield(future)
+        finally:
+            shutil.rmtree(directory, ignore_errors = True)
+        # (messages show the submission's name, not its spool file)
+        msg = msg.replace(filepath, name)
+        if query.get('format', [''])[0] == 'json':
+            return 200, 'application/json', \
+                json.dumps(dict(file = name, mark = mark, msg = msg,
+                                record = record)) + "\n"
+        return 200, 'text/plain', str(mark) + '|' + msg + "\n"
+
+    ## end class MarkingServer